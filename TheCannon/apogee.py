@@ -19,6 +19,9 @@ try:
 except ImportError:
     import pyfits
 
+from .helpers.prefetch import prefetch_map
+from .dataset import _cast_block, _report_cast, _new_npy_file
+
 def get_pixmask(fluxes, flux_errs):
     """ Create and return a bad pixel mask for an APOGEE spectrum
 
@@ -83,14 +86,49 @@ def get_starmask(ids, labels, aspcapflag, paramflag):
     return cuts | aspcapflag_bad | paramflag_bad 
 
 
-def load_spectra(data_dir):
+def _read_spectrum(fits_file):
+    """ Reads the flux, its uncertainty and the wavelength solution of an
+    apogee fits file, and closes it
+
+    Returns
+    -------
+    flux, flux_err: ndarray
+    start_wl, diff_wl: float
+        CRVAL1 and CDELT1, the log10 wavelength of the first pixel and
+        the log10 pixel width
+    """
+    with pyfits.open(fits_file) as file_in:
+        flux = np.array(file_in[1].data)
+        flux_err = np.array(file_in[2].data)
+        start_wl = file_in[1].header['CRVAL1']
+        diff_wl = file_in[1].header['CDELT1']
+    return flux, flux_err, start_wl, diff_wl
+
+
+def load_spectra(data_dir, dtype=float, n_threads=8, storage=None):
     """ Reads wavelength, flux, and flux uncertainty data from apogee fits files
 
+    The files are read by a pool of threads, a bounded number of files
+    ahead, and each spectrum is written straight into the cubes.
+
     Parameters
     ----------
     data_dir: str
         Name of the directory containing all of the data files
 
+    dtype: numpy dtype
+        dtype of the flux and ivar arrays, e.g. np.float32 to halve
+        their memory; each spectrum is cast as it is read, and the
+        precision lost is reported as in Dataset
+
+    n_threads: int
+        number of files read at the same time
+
+    storage: str, optional
+        directory in which the cubes are created as flux.npy and
+        ivar.npy, memory-mapped, instead of in memory; existing files are
+        never written over, the cubes then go to flux_1.npy, ...
+
     Returns
     -------
     wl: ndarray
@@ -106,25 +144,30 @@ def load_spectra(data_dir):
     files = list(sorted([data_dir + "/" + filename
              for filename in os.listdir(data_dir) if filename.endswith('fits')]))
     nstars = len(files)  
-    for jj, fits_file in enumerate(files):
-        file_in = pyfits.open(fits_file)
-        flux = np.array(file_in[1].data)
+    dtype = np.dtype(dtype)
+    lost = {"flux": [0., 0, 0], "ivar": [0., 0, 0]}
+    spectra = prefetch_map(_read_spectrum, files, n_threads=n_threads)
+    for jj, (flux, flux_err, start_wl, diff_wl) in enumerate(spectra):
         if jj == 0:
             npixels = len(flux)
-            fluxes = np.zeros((nstars, npixels), dtype=float)
-            ivars = np.zeros(fluxes.shape, dtype=float)
-            start_wl = file_in[1].header['CRVAL1']
-            diff_wl = file_in[1].header['CDELT1']
+            if storage is None:
+                fluxes = np.zeros((nstars, npixels), dtype=dtype)
+                ivars = np.zeros(fluxes.shape, dtype=dtype)
+            else:
+                fluxes, ivars = [_new_npy_file(
+                        storage, name, (nstars, npixels), dtype)
+                        for name in ["flux", "ivar"]]
             val = diff_wl * (npixels) + start_wl
             wl_full_log = np.arange(start_wl,val, diff_wl)
-            wl_full = [10 ** aval for aval in wl_full_log]
-            wl = np.array(wl_full)
-        flux_err = np.array((file_in[2].data))
+            wl = 10 ** wl_full_log
         badpix = get_pixmask(flux, flux_err)
         ivar = np.zeros(npixels)
-        ivar[~badpix] = 1. / flux_err[~badpix]**2
-        fluxes[jj,:] = flux
-        ivars[jj,:] = ivar
+        ivar[~badpix] = 1. / np.asarray(flux_err[~badpix], dtype=float)**2
+        fluxes[jj,:] = _cast_block(flux, dtype, lost["flux"])
+        ivars[jj,:] = _cast_block(ivar, dtype, lost["ivar"])
+    if dtype != np.float64:
+        for name in ["flux", "ivar"]:
+            _report_cast(name, dtype, lost[name])
     print("Spectra loaded")
     return files, wl, fluxes, ivars
 
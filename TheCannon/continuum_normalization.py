@@ -2,15 +2,212 @@ import numpy as np
 from functools import partial
 import multiprocessing as mp
 import matplotlib.pyplot as plt
-import scipy.optimize as opt
+from scipy.signal import fftconvolve
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+import tempfile
 # from joblib import Parallel, delayed
 
 SMALL = 1.0/200
 
-def _partial_func(func, *args, **kwargs):
-    def wrap(x, *p):
-        return func(x, p, **kwargs)
-    return wrap
+# views of the shared arrays, attached once per worker process by
+# _init_cont_worker
+_cont_worker = {}
+
+def _float_dtype(arr):
+    """ The dtype of arrays derived from a cube of spectra
+
+    float32 cubes give float32 continua and normalized spectra; anything
+    else gives float64. The sums are always accumulated in float64.
+    """
+    dtype = np.asarray(arr[:0]).dtype
+    if dtype.kind == 'f' and dtype.itemsize <= 8:
+        return dtype
+    return np.dtype(np.float64)
+
+
+def _share_array(arr):
+    """ Copy an array into memory that worker processes can attach to
+
+    Uses multiprocessing.shared_memory, or a memmapped temporary file on
+    pythons that do not have it.
+
+    Parameters
+    ----------
+    arr: numpy ndarray
+        the array to share
+
+    Returns
+    -------
+    handle: SharedMemory or file object
+        keeps the memory alive, to be released with _release_array
+    spec: tuple
+        (name, shape, dtype), enough for a worker to attach
+    view: numpy ndarray
+        the shared array, in this process
+    """
+    arr = np.asarray(arr)
+    if shared_memory is not None:
+        handle = shared_memory.SharedMemory(create=True,
+                                            size=max(arr.nbytes, 1))
+        name = handle.name
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=handle.buf)
+    else:
+        handle = tempfile.NamedTemporaryFile(suffix='.npy')
+        name = handle.name
+        view = np.memmap(name, dtype=arr.dtype, mode='w+', shape=arr.shape)
+    view[...] = arr
+    return handle, (name, arr.shape, arr.dtype.str), view
+
+
+def _attach_array(spec):
+    """ Attach to an array shared by _share_array, from a worker """
+    name, shape, dtype = spec
+    if shared_memory is not None:
+        handle = shared_memory.SharedMemory(name=name)
+        return handle, np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+    return None, np.memmap(name, dtype=dtype, mode='r+', shape=shape)
+
+
+def _release_array(handle):
+    """ Free the memory of an array shared by _share_array """
+    if shared_memory is not None:
+        handle.close()
+        handle.unlink()
+    else:
+        handle.close()
+
+
+def _init_cont_worker(specs, func):
+    """ Attach a worker process to the shared fluxes, ivars and continua """
+    _cont_worker['func'] = func
+    _cont_worker['arrays'] = [_attach_array(spec) for spec in specs]
+
+
+def _cont_worker_task(bounds):
+    """ Find the continuum of stars start:stop, in a worker process """
+    start, stop = bounds
+    (_, fluxes), (_, ivars), (_, cont) = _cont_worker['arrays']
+    cont[start:stop] = _cont_worker['func'](
+            fluxes[start:stop], ivars[start:stop])
+
+
+class _ContinuumPool(object):
+    """ A continuum finder evaluated by a pool of worker processes
+
+    The pool and the shared buffers for the fluxes, ivars and continua are
+    made once, and serve every block of spectra it is called on: a block
+    is copied into the shared buffers, the tasks only carry ranges of
+    rows, and the workers write their continua straight into the shared
+    output buffer. With n_proc == 1 the finder is called directly.
+
+    Parameters
+    ----------
+    func: callable
+        func(fluxes, ivars) returns the continuum of a block of stars;
+        it must be picklable, e.g. a functools.partial of a module-level
+        function
+    fluxes, ivars: numpy ndarray of shape (nstars, npixels)
+        spectra like the ones it will be called on, for their number of
+        pixels and dtypes
+    n_proc: int
+        number of worker processes
+    nrows: int, optional
+        largest number of spectra per call; by default len(fluxes)
+    chunk_size: int, optional
+        number of stars per task; by default every worker gets about
+        four tasks per call
+    """
+    def __init__(self, func, fluxes, ivars, n_proc, nrows=None,
+                 chunk_size=None):
+        self.func = func
+        self.n_proc = n_proc
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.shared = []
+        if n_proc == 1:
+            return
+        if nrows is None:
+            nrows = len(fluxes)
+        shape = (nrows, fluxes.shape[1])
+        try:
+            for dtype in [fluxes.dtype, ivars.dtype, _float_dtype(fluxes)]:
+                self.shared.append(_share_array(np.zeros(shape, dtype=dtype)))
+            self.pool = mp.Pool(
+                    processes=n_proc, initializer=_init_cont_worker,
+                    initargs=([spec for _, spec, _ in self.shared], func))
+        except Exception:
+            self.close()
+            raise
+
+    def __call__(self, fluxes, ivars):
+        """ The continuum of a block of at most nrows spectra """
+        if self.n_proc == 1:
+            return self.func(fluxes, ivars)
+        nstars = len(fluxes)
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, int(np.ceil(nstars / (4. * self.n_proc))))
+        bounds = [(start, min(start + chunk_size, nstars))
+                  for start in range(0, nstars, chunk_size)]
+        (_, _, shared_fluxes), (_, _, shared_ivars), (_, _, shared_cont) = \
+                self.shared
+        shared_fluxes[:nstars] = fluxes
+        shared_ivars[:nstars] = ivars
+        for _ in self.pool.imap_unordered(_cont_worker_task, bounds):
+            pass
+        return np.array(shared_cont[:nstars])
+
+    def close(self):
+        """ Stop the workers and free the shared buffers """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        while self.shared:
+            handle, _, view = self.shared.pop()
+            del view
+            _release_array(handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _find_cont_mp(func, fluxes, ivars, n_proc, chunk_size=None):
+    """ Evaluate a continuum finder on ranges of stars in a process pool
+
+    The fluxes and ivars are copied once into shared memory, see
+    _ContinuumPool.
+
+    Parameters
+    ----------
+    func: callable
+        func(fluxes, ivars) returns the continuum of a block of stars;
+        it must be picklable, e.g. a functools.partial of a module-level
+        function
+    fluxes: numpy ndarray of shape (nstars, npixels)
+        pixel intensities
+    ivars: numpy ndarray of shape (nstars, npixels)
+        inverse variances, parallel to fluxes
+    n_proc: int
+        number of worker processes
+    chunk_size: int, optional
+        number of stars per task; by default every worker gets about
+        four tasks
+
+    Returns
+    -------
+    cont: numpy ndarray of shape (nstars, npixels)
+        the continuum, parallel to fluxes
+    """
+    with _ContinuumPool(func, fluxes, ivars, n_proc,
+                        chunk_size=chunk_size) as find_cont:
+        return find_cont(fluxes, ivars)
 
 
 def gaussian_weight_matrix(wl, L):
@@ -58,6 +255,31 @@ def _sinusoid(x, p, L, y):
     return func
 
 
+def _sinusoid_basis(x, deg, L):
+    """ The sin and cos terms of _sinusoid, evaluated at x
+
+    Parameters
+    ----------
+    x: np.array
+        data, input to function
+    deg: int
+        number of frequencies, i.e. len(p)/2 in _sinusoid
+    L: float
+        width of x data
+
+    Returns
+    -------
+    basis: numpy ndarray of shape (len(x), 2*deg)
+        column 2*n is sin(k_n x) and column 2*n+1 is cos(k_n x), so that
+        np.dot(basis, p) is _sinusoid(x, p, L, y); column 0 is sin(0)
+    """
+    k = np.arange(deg)*np.pi/L
+    basis = np.zeros((len(x), 2*deg))
+    basis[:, 0::2] = np.sin(k[None, :]*np.asarray(x)[:, None])
+    basis[:, 1::2] = np.cos(k[None, :]*np.asarray(x)[:, None])
+    return basis
+
+
 def _weighted_median(values, weights, quantile):
     """ Calculate a weighted median for values above a particular quantile cut
 
@@ -88,6 +310,38 @@ def _weighted_median(values, weights, quantile):
     return values[indx]
 
 
+def _fit_basis(basis, ys, weights):
+    """ Weighted linear least squares fits of many spectra to one basis
+
+    Solves the normal equations of all spectra at once.
+
+    Parameters
+    ----------
+    basis: numpy ndarray of shape (npixels, nterms)
+        the basis functions, evaluated at the pixels
+    ys: numpy ndarray of shape (nstars, npixels)
+        the values to fit
+    weights: numpy ndarray of shape (nstars, npixels)
+        weights of the squared residuals
+
+    Returns
+    -------
+    coeffs: numpy ndarray of shape (nstars, nterms)
+        the best-fit coefficients
+    """
+    ys = np.asarray(ys, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    nterms = basis.shape[1]
+    prods = (basis[:, :, None] * basis[:, None, :]).reshape(-1, nterms**2)
+    ATA = np.dot(weights, prods).reshape(-1, nterms, nterms)
+    ATb = np.dot(weights * ys, basis)
+    try:
+        return np.linalg.solve(ATA, ATb[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # too few pixels for the degree; take the minimum-norm solution
+        return np.matmul(np.linalg.pinv(ATA), ATb[:, :, None])[:, :, 0]
+
+
 def _find_cont_gaussian_smooth(wl, fluxes, ivars, w):
     """ Returns the weighted mean block of spectra
 
@@ -111,40 +365,150 @@ def _find_cont_gaussian_smooth(wl, fluxes, ivars, w):
     bot = np.dot(ivars, w.T)
     top = np.dot(fluxes*ivars, w.T)
     bad = bot == 0
-    cont = np.zeros(top.shape)
+    cont = np.zeros(top.shape, dtype=_float_dtype(fluxes))
     cont[~bad] = top[~bad] / bot[~bad]
     return cont
 
 
-def _cont_norm_gaussian_smooth(dataset, L):
+def _find_cont_gaussian_smooth_banded(wl, fluxes, ivars, L, n_sigma=8.,
+                                      block_size=256):
+    """ Returns the weighted mean block of spectra, without a dense kernel
+
+    The same as _find_cont_gaussian_smooth with
+    w = gaussian_weight_matrix(wl, L), except that the Gaussian is
+    truncated at n_sigma*L; at the default, the dropped weights are below
+    1e-13 of the peak. Pixels with no ivar > 0 within n_sigma*L, which
+    only happens inside wide gaps, get a continuum of 0 rather than an
+    extrapolation from the far tails. On a uniform wavelength grid the kernel is applied
+    by FFT convolution, otherwise as a banded operator, one block of
+    pixels at a time.
+
+    Parameters
+    ----------
+    wl: numpy ndarray
+        wavelength vector, increasing
+    fluxes: numpy ndarray
+        block of flux values
+    ivars: numpy ndarray
+        block of ivar values
+    L: float
+        width of Gaussian used to assign weights
+    n_sigma: float
+        the kernel is cut at n_sigma*L
+    block_size: int
+        number of pixels smoothed at once by the banded operator
+
+    Returns
+    -------
+    smoothed_fluxes: numpy ndarray
+        block of smoothed flux values, mean spectra
+    """
+    wl = np.asarray(wl, dtype=float)
+    dtype = _float_dtype(fluxes)
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    ivars = np.asarray(ivars, dtype=np.float64)
+    npix = len(wl)
+    dwl = np.diff(wl)
+    if not np.all(dwl > 0):
+        return _find_cont_gaussian_smooth(
+                wl, fluxes, ivars, gaussian_weight_matrix(wl, L))
+    weighted = fluxes*ivars
+    lo, hi = _running_windows(wl, n_sigma*L)
+    if npix > 1 and np.allclose(dwl, dwl[0], rtol=1e-6, atol=0):
+        half = int(n_sigma*L/dwl[0])
+        kernel = np.exp(-0.5*(np.arange(-half, half+1)*dwl[0])**2/L**2)
+        bot = fftconvolve(ivars, kernel[None, :], mode='same', axes=1)
+        top = fftconvolve(weighted, kernel[None, :], mode='same', axes=1)
+        # the FFT leaves round-off where all the weights are 0
+        ngood = np.zeros((fluxes.shape[0], npix+1))
+        ngood[:, 1:] = np.cumsum(ivars > 0, axis=1)
+        bad = ngood[:, hi] - ngood[:, lo] == 0
+    else:
+        bot = np.zeros(fluxes.shape)
+        top = np.zeros(fluxes.shape)
+        for start in range(0, npix, block_size):
+            stop = min(start + block_size, npix)
+            a, b = lo[start], hi[stop-1]
+            w = np.exp(-0.5*(wl[start:stop, None]-wl[None, a:b])**2/L**2)
+            bot[:, start:stop] = np.dot(ivars[:, a:b], w.T)
+            top[:, start:stop] = np.dot(weighted[:, a:b], w.T)
+        bad = bot == 0
+    cont = np.zeros(top.shape, dtype=dtype)
+    cont[~bad] = top[~bad] / bot[~bad]
+    return cont
+
+
+def _map_spectra(dataset, which, func, names, block_size=1024):
+    """ Apply func to the spectra of a dataset, one block of rows at a time
+
+    This way a memory-mapped dataset is never read into memory at once;
+    the outputs are collected in cubes from dataset._empty_cube, which for
+    a memory-mapped dataset are new files in its storage directory.
+
+    Parameters
+    ----------
+    dataset: Dataset
+    which: str
+        "tr" for the training set, "test" for the test set
+    func: callable
+        func(start, stop, flux, ivar) returns one array per name, shaped
+        like flux, for the spectra start:stop
+    names: list of str
+        names of the outputs; the cubes are named which_name
+    block_size: int
+        number of spectra done at once
+
+    Returns
+    -------
+    list of numpy ndarray of shape (nstars, npixels), one per name; None
+    for each if the dataset has no such set, e.g. no training set
+    """
+    fluxes = getattr(dataset, "%s_flux" % which)
+    if fluxes is None:
+        return [None] * len(names)
+    dtype = _float_dtype(fluxes)
+    output = [dataset._empty_cube("%s_%s" % (which, name), fluxes.shape,
+                                  dtype)
+              for name in names]
+    for start, stop, flux, ivar in dataset.iter_spectra(which, block_size):
+        for cube, block in zip(output, func(start, stop, flux, ivar)):
+            cube[start:stop] = block
+    return output
+
+
+def _cont_norm_gaussian_smooth(dataset, L, block_size=1024):
     """ Continuum normalize by dividing by a Gaussian-weighted smoothed spectrum
 
+    The spectra are normalized in blocks of rows, see _map_spectra.
+
     Parameters
     ----------
     dataset: Dataset
         the dataset to continuum normalize
     L: float
         the width of the Gaussian used for weighting
+    block_size: int
+        number of spectra normalized at once
 
     Returns
     -------
-    dataset: Dataset
-        updated dataset
+    norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar:
+        normalized fluxes and rescaled inverse variances; None for a set
+        that the dataset does not have
     """
-    print("Gaussian smoothing the entire dataset...")
-    w = gaussian_weight_matrix(dataset.wl, L)
+    def normalize(start, stop, flux, ivar):
+        cont = _find_cont_gaussian_smooth_banded(dataset.wl, flux, ivar, L)
+        return _cont_norm(flux, ivar, cont)
 
-    print("Gaussian smoothing the training set")
-    cont = _find_cont_gaussian_smooth(
-            dataset.wl, dataset.tr_flux, dataset.tr_ivar, w)
-    norm_tr_flux, norm_tr_ivar = _cont_norm(
-            dataset.tr_flux, dataset.tr_ivar, cont)
-    print("Gaussian smoothing the test set")
-    cont = _find_cont_gaussian_smooth(
-            dataset.wl, dataset.test_flux, dataset.test_ivar, w)
-    norm_test_flux, norm_test_ivar = _cont_norm(
-            dataset.test_flux, dataset.test_ivar, cont)
-    return norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar 
+    print("Gaussian smoothing the entire dataset...")
+    output = []
+    for which in ["tr", "test"]:
+        if getattr(dataset, "%s_flux" % which) is not None:
+            print("Gaussian smoothing the %s set" %
+                  {"tr": "training", "test": "test"}[which])
+        output.extend(_map_spectra(dataset, which, normalize,
+                                   ["flux_norm", "ivar_norm"], block_size))
+    return tuple(output)
 
 
 def _find_cont_fitfunc(fluxes, ivars, contmask, deg, ffunc, n_proc=1):
@@ -176,46 +540,39 @@ def _find_cont_fitfunc(fluxes, ivars, contmask, deg, ffunc, n_proc=1):
     """
     nstars = fluxes.shape[0]
     npixels = fluxes.shape[1]
-    cont = np.zeros(fluxes.shape)
+    cont = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
 
     if n_proc == 1:
-        for jj in range(nstars):
-            flux = fluxes[jj,:]
-            ivar = ivars[jj,:]
-            pix = np.arange(0, npixels)
-            y = flux[contmask]
+        pix = np.arange(0, npixels)
+        if ffunc=="chebyshev":
+            x = pix[contmask]
+            yivar = ivars[:, contmask].copy()
+            yivar[yivar == 0] = SMALL**2
+            # the basis of Chebyshev.fit, mapping the span of the
+            # continuum pixels onto [-1, 1]; it is the same for all stars
+            off, scl = np.polynomial.polyutils.mapparms(
+                    [x.min(), x.max()], [-1, 1])
+            basis = np.polynomial.chebyshev.chebvander(off + scl*pix, deg)
+            # Chebyshev.fit weights the residuals, not their squares
+            coeffs = _fit_basis(basis[contmask], fluxes[:, contmask],
+                                yivar**2)
+            cont[:] = np.dot(coeffs, basis.T)
+        elif ffunc=="sinusoid":
             x = pix[contmask]
-            yivar = ivar[contmask]
+            yivar = ivars[:, contmask].copy()
             yivar[yivar == 0] = SMALL**2
-            if ffunc=="sinusoid":
-                p0 = np.ones(deg*2) # one for cos, one for sin
-                L = max(x)-min(x)
-                pcont_func = _partial_func(_sinusoid, L=L, y=flux)
-                popt, pcov = opt.curve_fit(pcont_func, x, y, p0=p0,
-                                           sigma=1./np.sqrt(yivar))
-            elif ffunc=="chebyshev":
-                fit = np.polynomial.chebyshev.Chebyshev.fit(x=x,y=y,w=yivar,deg=deg)
-            for element in pix:
-                if ffunc=="sinusoid":
-                    cont[jj,element] = _sinusoid(element, popt, L=L, y=flux)
-                elif ffunc=="chebyshev":
-                    cont[jj,element] = fit(element)
+            L = max(x)-min(x)
+            basis = _sinusoid_basis(pix, deg, L)
+            # the model is linear in its coefficients; the sin(0) term
+            # vanishes, and is left out of the fit
+            coeffs = _fit_basis(basis[contmask, 1:], fluxes[:, contmask],
+                                yivar)
+            cont[:] = np.dot(coeffs, basis[:, 1:].T)
     else:
-        # start mp.Pool
-        pool = mp.Pool(processes=n_proc)
-        mp_results = []
-        for i in xrange(nstars):
-            mp_results.append(pool.apply_async(\
-                _find_cont_fitfunc,
-                (fluxes[i, :].reshape((1, -1)),
-                 ivars[i, :].reshape((1, -1)),
-                 contmask[:]),
-                {'deg':deg, 'ffunc':ffunc}))
-        # close mp.Pool
-        pool.close()
-        pool.join()
-
-        cont = np.array([mp_results[i].get().flatten() for i in xrange(nstars)])
+        cont = _find_cont_mp(
+                partial(_find_cont_fitfunc, contmask=contmask, deg=deg,
+                        ffunc=ffunc),
+                fluxes, ivars, n_proc)
 
     return cont
 
@@ -248,9 +605,15 @@ def _find_cont_fitfunc_regions(fluxes, ivars, contmask, deg, ranges, ffunc,
     cont: numpy ndarray of shape (nstars, npixels)
         the continuum, parallel to fluxes
     """
+    if n_proc > 1:
+        # one pool for all the regions
+        return _find_cont_mp(
+                partial(_find_cont_fitfunc_regions, contmask=contmask,
+                        deg=deg, ranges=ranges, ffunc=ffunc),
+                fluxes, ivars, n_proc)
     nstars = fluxes.shape[0]
     npixels = fluxes.shape[1]
-    cont = np.zeros(fluxes.shape)
+    cont = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
     for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
@@ -258,23 +621,58 @@ def _find_cont_fitfunc_regions(fluxes, ivars, contmask, deg, ranges, ffunc,
             output = _find_cont_fitfunc(fluxes[:,start:stop],
                                         ivars[:,start:stop],
                                         contmask[start:stop],
-                                        deg=deg, ffunc="chebyshev",
-                                        n_proc=n_proc)
+                                        deg=deg, ffunc="chebyshev")
         elif ffunc=="sinusoid":
             output = _find_cont_fitfunc(fluxes[:,start:stop],
                                         ivars[:,start:stop],
                                         contmask[start:stop],
-                                        deg=deg, ffunc="sinusoid",
-                                        n_proc=n_proc)
+                                        deg=deg, ffunc="sinusoid")
         cont[:, start:stop] = output
 
     return cont
 
 
+def _running_windows(wl, delta_lambda):
+    """ Bounds of the running windows abs(wl-lam) < delta_lambda
+
+    Parameters
+    ----------
+    wl: numpy ndarray
+        wavelength vector, strictly increasing
+    delta_lambda: float
+        half-width of the windows
+
+    Returns
+    -------
+    lo, hi: numpy ndarray of ints
+        the window of pixel ll is wl[lo[ll]:hi[ll]]
+    """
+    npix = len(wl)
+    lo = np.searchsorted(wl, wl - delta_lambda, side='right')
+    hi = np.searchsorted(wl, wl + delta_lambda, side='left')
+    # the edges can be off by one where wl-lam rounds differently from
+    # lam-delta_lambda; settle them with the comparison used for the window
+    inside = lambda i: abs(wl[np.clip(i, 0, npix-1)] - wl) < delta_lambda
+    while True:
+        grow_lo = (lo > 0) & inside(lo-1)
+        shrink_lo = (lo < npix) & ~inside(lo)
+        grow_hi = (hi < npix) & inside(hi)
+        shrink_hi = (hi > 0) & ~inside(hi-1)
+        if not np.any(grow_lo | shrink_lo | grow_hi | shrink_hi):
+            return lo, hi
+        lo = lo - grow_lo + shrink_lo
+        hi = hi + grow_hi - shrink_hi
+
+
 def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
-                                verbose=False):
+                                verbose=False, block_size=2**22):
     """ Perform continuum normalization using a running quantile
 
+    The window bounds are found once with a binary search, and the
+    weighted quantile of all the stars is taken at once, for blocks of
+    pixels that have windows of the same width. The result is the same
+    as that of _weighted_median applied at every pixel of every star.
+
     Parameters
     ----------
     wl: numpy ndarray 
@@ -287,26 +685,53 @@ def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
         the desired quantile cut
     delta_lambda: int
         the number of pixels over which the median is calculated
+    block_size: int
+        maximum number of window elements sorted at once
 
     Output
     ------
-    norm_fluxes: numpy ndarray of shape (nstars, npixels)
-        normalized pixel intensities
-    norm_ivars: numpy ndarray of shape (nstars, npixels)
-        rescaled pixel invariances
+    cont: numpy ndarray of shape (nstars, npixels)
+        the continuum
     """
-    cont = np.zeros(fluxes.shape)
+    fluxes = np.atleast_2d(fluxes)
+    ivars = np.atleast_2d(ivars)
+    cont = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
     nstars = fluxes.shape[0]
-    for jj in range(nstars):
+    if not np.all(np.diff(wl) > 0):
+        # the windows are not contiguous, go pixel by pixel
+        for jj in range(nstars):
+            for ll, lam in enumerate(wl):
+                indx = (np.where(abs(wl-lam) < delta_lambda))[0]
+                cont[jj, ll] = _weighted_median(
+                        fluxes[jj, indx], ivars[jj, indx], q)
+        return cont
+
+    lo, hi = _running_windows(wl, delta_lambda)
+    width = hi - lo
+    for w in np.unique(width):
+        pixels = np.where(width == w)[0]
+        nblock = max(1, block_size // max(1, nstars * w))
         if verbose:
-            print("cont_norm_q(): working on star [%s/%s]..." % (jj+1, nstars))
-        flux = fluxes[jj,:]
-        ivar = ivars[jj,:]
-        for ll, lam in enumerate(wl):
-            indx = (np.where(abs(wl-lam) < delta_lambda))[0]
-            flux_cut = flux[indx]
-            ivar_cut = ivar[indx]
-            cont[jj, ll] = _weighted_median(flux_cut, ivar_cut, q)
+            print("cont_norm_q(): working on %s pixels of window width %s..."
+                  % (len(pixels), w))
+        for start in range(0, len(pixels), nblock):
+            pix = pixels[start:start+nblock]
+            indx = lo[pix, None] + np.arange(w)
+            values = fluxes[:, indx]
+            sindx = np.argsort(values, axis=-1)
+            cvalues = np.cumsum(
+                    np.take_along_axis(ivars[:, indx], sindx, axis=-1),
+                    axis=-1, dtype=np.float64)
+            total = cvalues[..., -1:]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                above = cvalues / total > q
+            first = np.take_along_axis(
+                    sindx, np.argmax(above, axis=-1)[..., None], axis=-1)
+            sorted_values = np.take_along_axis(values, first, axis=-1)[..., 0]
+            # where all the weights are 0, or nothing is above the cut,
+            # the first value of the window is returned
+            fallback = (total[..., 0] == 0) | ~np.any(above, axis=-1)
+            cont[:, pix] = np.where(fallback, values[..., 0], sorted_values)
     return cont
 
 
@@ -328,7 +753,7 @@ def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
 
 def _cont_norm_running_quantile(wl, fluxes, ivars, q, delta_lambda, verbose=True):
     cont = _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda, verbose=verbose)
-    norm_fluxes = np.ones(fluxes.shape)
+    norm_fluxes = np.ones(fluxes.shape, dtype=_float_dtype(fluxes))
     # norm_ivars = np.zeros(ivars.shape)
     norm_fluxes[cont!=0] = fluxes[cont!=0] / cont[cont!=0]
     norm_ivars = cont**2 * ivars
@@ -343,38 +768,29 @@ def _cont_norm_running_quantile_mp(wl, fluxes, ivars, q, delta_lambda,
     Bo Zhang (NAOC)
     """
     nStar = fluxes.shape[0]
-
-    # start mp.Pool
-    mp_results = []
-    pool = mp.Pool(processes=n_proc)
-    for i in xrange(nStar):
-        mp_results.append(pool.apply_async(\
-            _find_cont_running_quantile,
-            (wl, fluxes[i, :].reshape((1, -1)), ivars[i, :].reshape((1, -1)),
-             q, delta_lambda), {'verbose': False}))
-        if verbose:
-            print('@Bo Zhang: continuum normalizing star [%d/%d] ...'\
-                  % (i + 1, nStar))
-    # close mp.Pool
-    pool.close()
-    pool.join()
-
-    # reshape results --> cont
-    cont = np.zeros_like(fluxes)
-    for i in xrange(nStar):
-        cont[i, :] = mp_results[i].get() #.flatten()
-    norm_fluxes = np.ones(fluxes.shape)
+    if verbose:
+        print('@Bo Zhang: continuum normalizing %d stars ...' % nStar)
+    cont = _find_cont_mp(
+            partial(_find_cont_running_quantile, wl, q=q,
+                    delta_lambda=delta_lambda),
+            fluxes, ivars, n_proc)
+    norm_fluxes = np.ones(fluxes.shape, dtype=_float_dtype(fluxes))
     norm_fluxes[cont!=0] = fluxes[cont!=0] / cont[cont!=0]
     norm_ivars = cont**2 * ivars
 
     print('@Bo Zhang: continuum normalization finished!')
     return norm_fluxes, norm_ivars
 
-    # if use joblib
-    # mp_results = Parallel(n_jobs=n_proc)\
-    #     (delayed(_find_cont_running_quantile)\
-    #          (wl, fluxes[i, :].reshape((1, -1)), ivars[i, :].reshape((1, -1)), q, delta_lambda, False, True) for i in range(nStar))
-    # return mp_results
+
+def _find_cont_running_quantile_regions(wl, fluxes, ivars, q, delta_lambda,
+                                        ranges):
+    """ The running quantile continuum, for spectrum that comes in chunks """
+    cont = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
+    for start, stop in ranges:
+        cont[:, start:stop] = _find_cont_running_quantile(
+                wl[start:stop], fluxes[:, start:stop], ivars[:, start:stop],
+                q, delta_lambda)
+    return cont
 
 
 def _cont_norm_running_quantile_regions(wl, fluxes, ivars, q, delta_lambda,
@@ -385,8 +801,8 @@ def _cont_norm_running_quantile_regions(wl, fluxes, ivars, q, delta_lambda,
     print("contnorm.py: continuum norm using running quantile")
     print("Taking spectra in %s chunks" % len(ranges))
     nstars = fluxes.shape[0]
-    norm_fluxes = np.zeros(fluxes.shape)
-    norm_ivars = np.zeros(ivars.shape)
+    norm_fluxes = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
+    norm_ivars = np.zeros(ivars.shape, dtype=_float_dtype(ivars))
     for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
@@ -411,23 +827,22 @@ def _cont_norm_running_quantile_regions_mp(wl, fluxes, ivars, q, delta_lambda,
     """
     print("contnorm.py: continuum norm using running quantile")
     print("Taking spectra in %s chunks" % len(ranges))
-    # nstars = fluxes.shape[0]
-    nchunks = len(ranges)
-    norm_fluxes = np.zeros(fluxes.shape)
-    norm_ivars = np.zeros(ivars.shape)
-    for i in xrange(nchunks):
-        chunk = ranges[i, :]
+    # all the chunks are done by the same pool
+    cont = _find_cont_mp(
+            partial(_find_cont_running_quantile_regions, wl, q=q,
+                    delta_lambda=delta_lambda, ranges=ranges),
+            fluxes, ivars, n_proc)
+    norm_fluxes = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
+    norm_ivars = np.zeros(ivars.shape, dtype=_float_dtype(ivars))
+    for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
-        if verbose:
-            print('@Bo Zhang: Going to normalize Chunk [%d/%d], pixel:[%d, %d] ...'
-                  % (i+1, nchunks, start, stop))
-        output = _cont_norm_running_quantile_mp(
-            wl[start:stop], fluxes[:, start:stop],
-            ivars[:, start:stop], q, delta_lambda,
-            n_proc=n_proc, verbose=verbose)
-        norm_fluxes[:, start:stop] = output[0]
-        norm_ivars[:, start:stop] = output[1]
+        flux = fluxes[:, start:stop]
+        c = cont[:, start:stop]
+        norm_flux = np.ones(flux.shape)
+        norm_flux[c!=0] = flux[c!=0] / c[c!=0]
+        norm_fluxes[:, start:stop] = norm_flux
+        norm_ivars[:, start:stop] = c**2 * ivars[:, start:stop]
     return norm_fluxes, norm_ivars
 
 
@@ -452,10 +867,10 @@ def _cont_norm(fluxes, ivars, cont):
     """
     nstars = fluxes.shape[0]
     npixels = fluxes.shape[1]
-    norm_fluxes = np.ones(fluxes.shape)
-    norm_ivars = np.zeros(ivars.shape)
+    norm_fluxes = np.ones(fluxes.shape, dtype=_float_dtype(fluxes))
+    norm_ivars = np.zeros(ivars.shape, dtype=_float_dtype(ivars))
     bad = cont == 0.
-    norm_fluxes = np.ones(fluxes.shape)
+    norm_fluxes = np.ones(fluxes.shape, dtype=_float_dtype(fluxes))
     norm_fluxes[~bad] = fluxes[~bad] / cont[~bad]
     norm_ivars = cont**2 * ivars
     return norm_fluxes, norm_ivars 
@@ -485,8 +900,8 @@ def _cont_norm_regions(fluxes, ivars, cont, ranges):
         rescaled inverse variances
     """
     nstars = fluxes.shape[0]
-    norm_fluxes = np.zeros(fluxes.shape)
-    norm_ivars = np.zeros(ivars.shape)
+    norm_fluxes = np.zeros(fluxes.shape, dtype=_float_dtype(fluxes))
+    norm_ivars = np.zeros(ivars.shape, dtype=_float_dtype(ivars))
     for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
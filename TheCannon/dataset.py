@@ -1,5 +1,7 @@
 from __future__ import (absolute_import, division, print_function)
 import numpy as np
+import os
+from functools import partial
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -8,13 +10,15 @@ rc('text', usetex=True)
 rc('font', family='serif')
 from .helpers.corner import corner
 from .helpers import Table
+from .helpers.snr import median_SNR
 from .find_continuum_pixels import * 
 from .continuum_normalization import \
-    (_cont_norm_gaussian_smooth,
-     _cont_norm_running_quantile,
-     _cont_norm_running_quantile_regions,
-     _cont_norm_running_quantile_mp,
-     _cont_norm_running_quantile_regions_mp,
+    (_float_dtype,
+     _map_spectra,
+     _ContinuumPool,
+     _cont_norm_gaussian_smooth,
+     _find_cont_running_quantile,
+     _find_cont_running_quantile_regions,
      _find_cont_fitfunc,
      _find_cont_fitfunc_regions,
      _cont_norm,
@@ -28,6 +32,10 @@ n_cpus = cpu_count()
 
 PY3 = sys.version_info[0] > 2
 
+# arrays written by Dataset.write_to_npy, and read by read_from_npy
+NPY_ARRAYS = ['wl', 'tr_ID', 'tr_flux', 'tr_ivar', 'tr_label', 'tr_delta',
+              'test_ID', 'test_flux', 'test_ivar', 'ranges']
+
 if PY3:
     basestring = (str, bytes)
 else:
@@ -35,11 +43,24 @@ else:
 
 
 class Dataset(object):
-    """ A class to represent Cannon input: a dataset of spectra and labels """
+    """ A class to represent Cannon input: a dataset of spectra and labels
+
+    The flux and ivar cubes are kept in the dtype they are given in, or
+    cast to `dtype` (e.g. np.float32, to halve their memory); continua and
+    normalized spectra follow the dtype of the cubes, while the training
+    and inference sums are always done in float64.
+    """
 
-    def __init__(self, wl, tr_ID, tr_flux, tr_ivar, tr_label, tr_delta, test_ID, test_flux, test_ivar, coeff_old, scatter_old):
+    def __init__(self, wl, tr_ID, tr_flux, tr_ivar, tr_label, tr_delta, test_ID, test_flux, test_ivar, coeff_old, scatter_old, dtype=None):
         print("Loading dataset")
-        print("This may take a while...")
+        # quantities derived from the spectra, computed on first access
+        # and dropped when the spectra are replaced
+        self._derived = {}
+        if dtype is not None:
+            tr_flux = _cast_cube("tr_flux", tr_flux, dtype)
+            tr_ivar = _cast_cube("tr_ivar", tr_ivar, dtype)
+            test_flux = _cast_cube("test_flux", test_flux, dtype)
+            test_ivar = _cast_cube("test_ivar", test_ivar, dtype)
         self.wl = wl
         self.tr_ID = tr_ID
         self.tr_flux = tr_flux
@@ -53,12 +74,71 @@ class Dataset(object):
         self.scatter_old = scatter_old
         self._label_names = None
         self.ranges = None
-        
-        # calculate SNR
-        self.tr_SNR = np.array(
-                [self._SNR(*s) for s in zip(tr_flux, tr_ivar)])
-        self.test_SNR = np.array(
-                [self._SNR(*s) for s in zip(test_flux, test_ivar)])
+        # directory of the .npy files of a memory-mapped dataset
+        self.storage = None
+
+
+    def _set_cube(self, name, cube):
+        """ Replace a flux or ivar cube, dropping what was derived from it """
+        self.__dict__["_" + name] = cube
+        which = name.split("_")[0]
+        for key in list(self._derived):
+            if key.startswith(which + "_"):
+                del self._derived[key]
+
+
+    tr_flux = property(lambda self: self._tr_flux,
+                       lambda self, cube: self._set_cube("tr_flux", cube))
+    tr_ivar = property(lambda self: self._tr_ivar,
+                       lambda self, cube: self._set_cube("tr_ivar", cube))
+    test_flux = property(lambda self: self._test_flux,
+                         lambda self, cube: self._set_cube("test_flux", cube))
+    test_ivar = property(lambda self: self._test_ivar,
+                         lambda self, cube: self._set_cube("test_ivar", cube))
+
+
+    def _get_SNR(self, which):
+        """ SNR of the "tr" or "test" spectra, computed on first access """
+        key = "%s_SNR" % which
+        if key not in self._derived:
+            fluxes = getattr(self, "%s_flux" % which)
+            if fluxes is None:
+                return None
+            self._derived[key] = self._SNRs(
+                    fluxes, getattr(self, "%s_ivar" % which))
+        return self._derived[key]
+
+
+    tr_SNR = property(lambda self: self._get_SNR("tr"),
+                      doc="SNR of the training spectra")
+    test_SNR = property(lambda self: self._get_SNR("test"),
+                        doc="SNR of the test spectra")
+
+
+    def _SNRs(self, fluxes, ivars, block_size=1024):
+        """ Calculate the SNR of a block of spectra, ignoring bad pixels
+
+        The same as _SNR for every spectrum, with the bad pixels masked
+        and the medians of a whole block of rows taken at once.
+
+        Parameters
+        ----------
+        fluxes: numpy ndarray or memmap
+            pixel intensities
+        ivars: numpy ndarray or memmap
+            inverse variances corresponding to fluxes
+        block_size: int
+            number of spectra read at once
+
+        Returns
+        -------
+        SNR: numpy ndarray
+        """
+        SNR = np.zeros(len(fluxes))
+        for start, stop in _row_blocks(len(fluxes), block_size):
+            ivar = np.asarray(ivars[start:stop], dtype=np.float64)
+            SNR[start:stop] = median_SNR(fluxes[start:stop], ivar, ivar != 0)
+        return SNR
 
 
     def _SNR(self, flux, ivar):
@@ -106,79 +186,86 @@ class Dataset(object):
             return self._label_names
 
 
-    def bin_flux(flux, ivar):
-        """ bin two neighboring flux values """
-        if np.sum(ivar)==0:
-            return np.sum(flux)/2.
-        return np.average(flux, weights=ivar)
+    def bin_spectra(self, factor=2, block_size=1024):
+        """ Bin down all of the spectra by an integer factor
 
+        Every factor neighboring pixels become one, with the
+        inverse-variance weighted mean flux and the summed inverse
+        variance; where all the ivars of a bin are 0, the flux is the
+        plain mean. Leftover pixels at the end of the spectrum, or of each
+        region if self.ranges is set, are discarded.
 
-    def smooth_spectrum(wl, flux, ivar):
-        """ Bins down one spectrum 
-        
         Parameters
         ----------
-        wl: numpy ndarray
-            wavelengths
-        flux: numpy ndarray
-            flux values
-        ivar: numpy ndarray
-            inverse variances associated with fluxes
-
-        Returns
-        -------
-        wl: numpy ndarray
-            updated binned pixel wavelengths
-        flux: numpy ndarray
-            updated binned flux values
-        ivar: numpy ndarray
-            updated binned inverse variances
+        factor: int
+            number of pixels per bin
+        block_size: int
+            number of spectra binned at once
         """
-        # if odd, discard the last point
-        if len(wl)%2 == 1:
-            wl = np.delete(wl, -1)
-            flux = np.delete(flux, -1)
-            ivar = np.delete(ivar, -1)
-        wl = wl.reshape(-1,2)
-        ivar = ivar.reshape(-1,2)
-        flux = flux.reshape(-1,2)
-        wl_binned = np.mean(wl, axis=1)
-        ivar_binned = np.sqrt(np.sum(ivar**2, axis=1))
-        flux_binned = np.array([bin_flux(f,w) for f,w in zip(flux, ivar)])
-        return wl_binned, flux_binned, ivar_binned
-
-
-    def smooth_spectra(wl, fluxes, ivars):
-        """ Bins down a block of spectra """
-        output = np.asarray(
-                [smooth_spectrum(wl, flux, ivar) for flux,ivar in zip(fluxes, ivars)])
-        return output 
-
-
-    def smooth_dataset(self):
+        ranges = self.ranges
+        if ranges is None:
+            ranges = [[0, len(self.wl)]]
+        pix = _bin_pixels(ranges, factor)
+        wl = np.asarray(self.wl)
+        self.wl = wl[pix].mean(axis=1)
+        if getattr(self, "contmask", None) is not None:
+            self.contmask = np.all(self.contmask[pix], axis=1)
+        for which in ["tr", "test"]:
+            fluxes = getattr(self, "%s_flux" % which)
+            if fluxes is None:
+                continue
+            dtype = _float_dtype(fluxes)
+            shape = (len(fluxes), len(pix))
+            # named after the cubes they are binned from, so that binning
+            # twice gives e.g. tr_flux_bin2_bin2.npy
+            binned_flux = self._empty_cube(
+                    "%s_bin%s" % (_cube_name(fluxes, "%s_flux" % which),
+                                  factor), shape, dtype)
+            binned_ivar = self._empty_cube(
+                    "%s_bin%s" % (_cube_name(getattr(self, "%s_ivar" % which),
+                                             "%s_ivar" % which),
+                                  factor), shape, dtype)
+            for start, stop, flux, ivar in self.iter_spectra(which, block_size):
+                binned_flux[start:stop], binned_ivar[start:stop] = \
+                        _bin_cube(flux, ivar, pix)
+            setattr(self, "%s_flux" % which, binned_flux)
+            setattr(self, "%s_ivar" % which, binned_ivar)
+        if self.ranges is not None:
+            nbins = [(stop - start) // factor for start, stop in self.ranges]
+            ends = np.cumsum(nbins)
+            self.ranges = np.array([ends - nbins, ends]).T
+        print("Binned the spectra down to %s pixels" % len(self.wl))
+
+
+    def smooth_dataset(self, factor=2):
         """ Bins down all of the spectra and updates the dataset """
-        output = smooth_spectra(self.wl, self.tr_flux, self.tr_ivar)
-        self.wl = output[:,0,:]
-        self.tr_flux = output[:,1,:]
-        self.tr_ivar = output[:,2,:]
-        output = smooth_spectra(self.wl, self.test_flux, self.test_ivar)
-        self.test_flux = output[:,1,:]
-        self.test_ivar = output[:,2,:]
- 
+        self.bin_spectra(factor)
+
 
     def diagnostics_SNR(self): 
-        """ Plots SNR distributions of ref and test object spectra """
+        """ Plots SNR distributions of ref and test object spectra
+
+        Only the sets that the dataset has are plotted.
+        """
         print("Diagnostic for SNRs of reference and survey objects")
         fig = plt.figure()
+        plotted = []
         data = self.test_SNR
-        plt.hist(data, bins=int(np.sqrt(len(data))), alpha=0.5, facecolor='r', 
-                label="Survey Objects")
+        if data is not None:
+            plt.hist(data, bins=int(np.sqrt(len(data))), alpha=0.5,
+                    facecolor='r', label="Survey Objects")
+            plotted.append("Survey Objects")
         data = self.tr_SNR
-        plt.hist(data, bins=int(np.sqrt(len(data))), alpha=0.5, color='b',
-                label="Ref Objects")
+        if data is not None:
+            plt.hist(data, bins=int(np.sqrt(len(data))), alpha=0.5,
+                    color='b', label="Ref Objects")
+            plotted.append("Reference Objects")
         plt.legend(loc='upper right')
         #plt.xscale('log')
-        plt.title("SNR Comparison Between Reference and Survey Objects")
+        if len(plotted) == 2:
+            plt.title("SNR Comparison Between Reference and Survey Objects")
+        else:
+            plt.title("SNR of %s" % " and ".join(plotted))
         #plt.xlabel("log(Formal SNR)")
         plt.xlabel("Formal SNR")
         plt.ylabel("Number of Objects")
@@ -249,15 +336,23 @@ class Dataset(object):
         self.contmask = contmask
 
 
-    def fit_continuum(self, deg, ffunc, n_proc=1):
+    def fit_continuum(self, deg, ffunc, n_proc=1, block_size=1024):
         """ Fit a continuum to the continuum pixels
 
+        The spectra are fit in blocks of rows; with n_proc > 1 one pool of
+        worker processes, sharing a buffer of block_size spectra, fits all
+        the blocks of both sets.
+
         Parameters
         ----------
         deg: int
             Degree of the fitting function
         ffunc: str
             Type of fitting function, 'sinusoid' or 'chebyshev'
+        n_proc: int
+            number of processes
+        block_size: int
+            number of spectra fit at once
 
         Returns
         -------
@@ -265,42 +360,59 @@ class Dataset(object):
             Flux values corresponding to the fitted continuum of training objects
         test_cont: ndarray
             Flux values corresponding to the fitted continuum of test objects
+
+        A set that the dataset does not have gets None.
         """
         print("Fitting Continuum...")
-        if self.ranges == None:
-            tr_cont = _find_cont_fitfunc(
-                self.tr_flux, self.tr_ivar, self.contmask, deg, ffunc,
-                n_proc=n_proc)
-            test_cont = _find_cont_fitfunc(
-                self.test_flux, self.test_ivar, self.contmask, deg, ffunc,
-                n_proc=n_proc)
+        if self.ranges is None:
+            fit = partial(_find_cont_fitfunc, contmask=self.contmask,
+                          deg=deg, ffunc=ffunc)
         else:
             print("Fitting Continuum in %s Regions..." %len(self.ranges))
-            tr_cont = _find_cont_fitfunc_regions(
-                self.tr_flux, self.tr_ivar, self.contmask, deg, self.ranges,
-                ffunc, n_proc=n_proc)
-            test_cont = _find_cont_fitfunc_regions(
-                self.test_flux, self.test_ivar, self.contmask, deg, self.ranges,
-                ffunc, n_proc=n_proc)
+            fit = partial(_find_cont_fitfunc_regions, contmask=self.contmask,
+                          deg=deg, ranges=self.ranges, ffunc=ffunc)
+        with self._continuum_pool(fit, n_proc, block_size) as fit:
+            tr_cont, = _map_spectra(
+                    self, "tr",
+                    lambda start, stop, flux, ivar: [fit(flux, ivar)],
+                    ["cont"], block_size)
+            test_cont, = _map_spectra(
+                    self, "test",
+                    lambda start, stop, flux, ivar: [fit(flux, ivar)],
+                    ["cont"], block_size)
         return tr_cont, test_cont
 
 
     def continuum_normalize_training_q(self, q, delta_lambda,
-                                       n_proc=1, verbose=True):
+                                       n_proc=1, verbose=True,
+                                       block_size=1024):
         """ Continuum normalize the training set using a running quantile
 
+        The spectra are normalized in blocks of rows; with n_proc > 1 one
+        pool of worker processes, sharing a buffer of block_size spectra,
+        does all the blocks.
+
         Parameters
         ----------
         q: float
             The quantile cut
         delta_lambda: float
             The width of the pixel range used to calculate the median
+        block_size: int
+            number of spectra normalized at once
+
+        Returns
+        -------
+        norm_tr_flux, norm_tr_ivar: ndarray
+            normalized fluxes and rescaled inverse variances; None if
+            there is no training set
 
 
         Modified by:
             [08 Jun 2016] Bo Zhang (NAOC):    add multiprocessing option
         Note:
-            Multiprocessing calls for more memory on computer.
+            With n_proc > 1 each block of spectra is copied to shared
+            memory, and the worker processes fill in the continuum in place.
         """
 
         # don't use too many process
@@ -310,48 +422,49 @@ class Dataset(object):
 
         print("Continuum normalizing the tr set using running quantile...")
 
+        if self.ranges is None:
+            find_cont = partial(_find_cont_running_quantile, self.wl, q=q,
+                                delta_lambda=delta_lambda)
+        else:
+            print("Taking spectra in %s chunks" % len(self.ranges))
+            find_cont = partial(_find_cont_running_quantile_regions, self.wl,
+                                q=q, delta_lambda=delta_lambda,
+                                ranges=self.ranges)
         if n_proc == 1:
             # use old version (single process)
             print('##########################################################')
             print('@Bo Zhang: you will use only 1 process ...')
             print('           i.e., the original TheCannon version')
             print('##########################################################')
-            if self.ranges is None:
-                return _cont_norm_running_quantile(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    verbose=verbose)
-            else:
-                return _cont_norm_running_quantile_regions(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    ranges=self.ranges, verbose=verbose)
         else:
             # use new version (multi process)
             print('##########################################################')
             print('@Bo Zhang: you will use ** %d ** processes ... ' % n_proc)
-            print('Note: Multiprocessing calls for more memory on computer!')
             print('##########################################################')
-            if self.ranges is None:
-                return _cont_norm_running_quantile_mp(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    n_proc=n_proc, verbose=verbose)
-            else:
-                return _cont_norm_running_quantile_regions_mp(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda, ranges=self.ranges,
-                    n_proc=n_proc, verbose=verbose)
-
-
-    def continuum_normalize(self, cont):
+
+        with self._continuum_pool(find_cont, n_proc, block_size) as find_cont:
+            def normalize(start, stop, flux, ivar):
+                if verbose:
+                    print("Continuum normalizing stars %s to %s" %
+                          (start, stop))
+                return _cont_norm(flux, ivar, find_cont(flux, ivar))
+
+            return tuple(_map_spectra(self, "tr", normalize,
+                                      ["flux_norm", "ivar_norm"], block_size))
+
+
+    def continuum_normalize(self, cont, block_size=1024):
         """ 
         Continuum normalize spectra, in chunks if spectrum has regions 
 
+        The spectra are normalized in blocks of rows.
+
         Parameters
         ----------
         cont: ndarray
            Flux values corresponding to the continuum 
+        block_size: int
+            number of spectra normalized at once
 
         Returns
         -------
@@ -363,24 +476,27 @@ class Dataset(object):
             Normalized flux values for the test objects
         norm_test_ivar: numpy ndarray
             Rescaled inverse variance values for the test objects
+
+        A set that the dataset does not have gets None.
         """
         tr_cont, test_cont = cont
         if self.ranges is None:
             print("assuming continuous spectra")
-            norm_tr_flux, norm_tr_ivar = _cont_norm(
-                    self.tr_flux, self.tr_ivar, tr_cont)
-            norm_test_flux, norm_test_ivar = _cont_norm(
-                    self.test_flux, self.test_ivar, test_cont)
+            norm = _cont_norm
         else:
             print("taking spectra in %s regions" %(len(self.ranges)))
-            norm_tr_flux, norm_tr_ivar = _cont_norm_regions(
-                    self.tr_flux, self.tr_ivar, tr_cont, self.ranges)
-            norm_test_flux, norm_test_ivar = _cont_norm_regions(
-                    self.test_flux, self.test_ivar, test_cont, self.ranges)
-        return norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar
-
-
-    def continuum_normalize_gaussian_smoothing(self, L):
+            norm = partial(_cont_norm_regions, ranges=self.ranges)
+        output = []
+        for which, cont in [("tr", tr_cont), ("test", test_cont)]:
+            output.extend(_map_spectra(
+                    self, which,
+                    lambda start, stop, flux, ivar:
+                        norm(flux, ivar, np.asarray(cont[start:stop])),
+                    ["flux_norm", "ivar_norm"], block_size))
+        return tuple(output)
+
+
+    def continuum_normalize_gaussian_smoothing(self, L, block_size=1024):
         """ Continuum normalize using a Gaussian-weighted smoothed spectrum
 
         Parameters
@@ -389,9 +505,11 @@ class Dataset(object):
             the dataset to continuum normalize
         L: float
             the width of the Gaussian used for weighting
+        block_size: int
+            number of spectra normalized at once
         """
         norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar = \
-                _cont_norm_gaussian_smooth(self, L)
+                _cont_norm_gaussian_smooth(self, L, block_size=block_size)
         self.tr_flux = norm_tr_flux
         self.tr_ivar = norm_tr_ivar
         self.test_flux = norm_test_flux
@@ -490,15 +608,18 @@ class Dataset(object):
             plt.close()
 
 
-    def set_test_label_vals(self, vals):
+    def set_test_label_vals(self, vals, converged=None):
         """ Set test label values  
 
         Parameters
         ----------
         vals: ndarray
             Test label values
+        converged: ndarray of bool, optional
+            False for the stars whose label fit did not converge
         """
         self.test_label_vals = vals
+        self.test_label_converged = converged
 
     
     def diagnostics_best_fit_spectra(self, model):
@@ -506,6 +627,85 @@ class Dataset(object):
         overlay_spectra(model, self)
 
 
+    def iter_spectra(self, which="test", block_size=1024):
+        """ Iterate over the spectra in blocks of rows
+
+        For a memory-mapped dataset only one block is read into memory
+        at a time.
+
+        Parameters
+        ----------
+        which: str
+            "tr" for the training set, "test" for the test set
+        block_size: int
+            number of spectra per block
+
+        Returns
+        -------
+        generator of (start, stop, flux, ivar), where flux and ivar are
+        in-memory copies of rows start:stop
+        """
+        fluxes = getattr(self, "%s_flux" % which)
+        ivars = getattr(self, "%s_ivar" % which)
+        for start, stop in _row_blocks(len(fluxes), block_size):
+            yield (start, stop, np.array(fluxes[start:stop]),
+                   np.array(ivars[start:stop]))
+
+
+    def _continuum_pool(self, func, n_proc, block_size):
+        """ A _ContinuumPool of func for the blocks of spectra of the dataset
+
+        Its shared buffers hold one block of block_size spectra; the
+        training and test sets are assumed to have the same dtypes.
+        """
+        if n_proc == 1:
+            return _ContinuumPool(func, None, None, n_proc)
+        which = "tr" if self.tr_flux is not None else "test"
+        nrows = max(len(flux) for flux in [self.tr_flux, self.test_flux]
+                    if flux is not None)
+        return _ContinuumPool(func, getattr(self, "%s_flux" % which),
+                              getattr(self, "%s_ivar" % which), n_proc,
+                              nrows=min(nrows, block_size))
+
+
+    def _empty_cube(self, name, shape, dtype=np.float64):
+        """ An array for a derived data cube, e.g. normalized fluxes
+
+        For a memory-mapped dataset this is a new .npy file in the storage
+        directory, mapped for writing; otherwise it is an in-memory array.
+        The file is name.npy, or name_1.npy, name_2.npy, ... if that
+        exists: an existing file is never written over, since it may be
+        the very cube being read, e.g. when normalizing twice.
+        """
+        if self.storage is None:
+            return np.zeros(shape, dtype=dtype)
+        return _new_npy_file(self.storage, name, shape, dtype)
+
+
+    def write_to_npy(self, directory):
+        """ Write the dataset as uncompressed .npy files, one per array
+
+        The files can be memory-mapped by read_from_npy, so that data sets
+        larger than the memory can be processed in blocks of spectra.
+
+        Parameters
+        ----------
+        directory: str
+            where the files are written; it is created if needed
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in NPY_ARRAYS:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            arr = np.asarray(arr)
+            if arr.dtype.kind == "O":
+                arr = arr.astype(str)
+            np.save(os.path.join(directory, "%s.npy" % name), arr)
+        print("Wrote dataset to %s" % directory)
+
+
     def write_to_fits(self, filepath, **kwargs):
         hl = convert_to_hdulist(self)
         print('@Bo Zhang: writting to fits [%s] ...' % filepath)
@@ -513,6 +713,193 @@ class Dataset(object):
         print('@Bo Zhang: ---------------------------------------------------')
 
 
+def _new_npy_file(directory, name, shape, dtype=np.float64):
+    """ A new .npy file in directory, memory-mapped for writing
+
+    The file is name.npy, or name_1.npy, name_2.npy, ... if that exists:
+    an existing file is never written over, since it may be mapped by
+    another array.
+    """
+    path = os.path.join(directory, "%s.npy" % name)
+    n = 0
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, "%s_%s.npy" % (name, n))
+    print("Writing %s" % path)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                     shape=shape)
+
+
+def _cube_name(cube, default):
+    """ Name of the .npy file a memory-mapped cube is read from, or default """
+    filename = getattr(cube, "filename", None)
+    if filename is None:
+        return default
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _row_blocks(nrows, block_size):
+    """ Start and stop of consecutive blocks of block_size rows """
+    for start in range(0, nrows, block_size):
+        yield start, min(start + block_size, nrows)
+
+
+def _bin_pixels(ranges, factor):
+    """ Indices of the pixels in each bin, within each region
+
+    Returns
+    -------
+    pix: numpy ndarray of shape (nbins, factor)
+    """
+    pix = [np.arange(start, start + (stop - start) // factor * factor)
+           for start, stop in ranges]
+    return np.concatenate(pix).reshape(-1, factor)
+
+
+def _bin_cube(fluxes, ivars, pix):
+    """ Bin a block of spectra into the bins pix, weighting by ivar
+
+    Returns
+    -------
+    fluxes, ivars: numpy ndarray of shape (nstars, nbins)
+        the inverse-variance weighted mean flux, or the mean flux where
+        all the ivars of a bin are 0, and the summed ivar
+    """
+    fluxes = np.asarray(fluxes, dtype=np.float64)[:, pix]
+    ivars = np.asarray(ivars, dtype=np.float64)[:, pix]
+    ivar = ivars.sum(axis=2)
+    flux = fluxes.mean(axis=2)
+    good = ivar != 0
+    flux[good] = (fluxes*ivars).sum(axis=2)[good] / ivar[good]
+    return flux, ivar
+
+
+def _cast_cube(name, cube, dtype, block_size=1024):
+    """ Cast a cube of spectra to dtype, reporting the precision lost
+
+    Parameters
+    ----------
+    name: str
+        name of the cube, for the report
+    cube: numpy ndarray or memmap
+        the cube, of shape (nstars, npixels); it is read in row blocks
+    dtype: numpy dtype
+        the dtype to cast to
+    block_size: int
+        number of spectra cast at once
+
+    Returns
+    -------
+    cube: numpy ndarray
+        the cube in dtype; the input itself if it already is
+    """
+    dtype = np.dtype(dtype)
+    if cube is None or cube.dtype == dtype:
+        return cube
+    out = np.empty(cube.shape, dtype=dtype)
+    lost = [0., 0, 0]
+    for start, stop in _row_blocks(len(cube), block_size):
+        out[start:stop] = _cast_block(cube[start:stop], dtype, lost)
+    _report_cast(name, dtype, lost)
+    return out
+
+
+def _cast_block(block, dtype, lost):
+    """ Cast a block of spectra to dtype, keeping count of the precision lost
+
+    Parameters
+    ----------
+    block: numpy ndarray
+        the spectra
+    dtype: numpy dtype
+        the dtype to cast to
+    lost: list
+        [max relative error, number of values flushed to zero, number of
+        values overflowed], updated in place, see _report_cast
+
+    Returns
+    -------
+    cast: numpy ndarray
+        the block in dtype
+    """
+    block = np.asarray(block)
+    with np.errstate(over='ignore'):
+        cast = block.astype(dtype)
+    finite = np.isfinite(block)
+    lost[2] += np.sum(finite & ~np.isfinite(cast))
+    lost[1] += np.sum((block != 0) & (cast == 0))
+    check = finite & np.isfinite(cast) & (block != 0)
+    if np.any(check):
+        rel_err = np.abs((cast[check] - block[check]) / block[check])
+        lost[0] = max(lost[0], float(rel_err.max()))
+    return cast
+
+
+def _report_cast(name, dtype, lost):
+    """ Print the precision lost in casting a cube, counted by _cast_block """
+    print("%s: cast to %s, max relative error %.2g, "
+          "%s values flushed to zero, %s values overflowed"
+          % (name, np.dtype(dtype).name, lost[0], lost[1], lost[2]))
+
+
+def inference_dataset(wl, test_ID, test_flux, test_ivar, dtype=None):
+    """ A Dataset holding only test spectra, for label inference
+
+    Parameters
+    ----------
+    wl: numpy ndarray
+        wavelength vector
+    test_ID: numpy ndarray
+        IDs of the test objects
+    test_flux: numpy ndarray or memmap
+        pixel intensities of the test objects
+    test_ivar: numpy ndarray or memmap
+        inverse variances, parallel to test_flux
+    dtype: numpy dtype, optional
+        see Dataset
+
+    Returns
+    -------
+    ds: Dataset
+        with no training set
+    """
+    return Dataset(wl, None, None, None, None, None, test_ID, test_flux,
+                   test_ivar, None, None, dtype=dtype)
+
+
+def read_from_npy(directory, mmap_mode="r"):
+    """ Read a dataset written by Dataset.write_to_npy
+
+    Parameters
+    ----------
+    directory: str
+        the directory written by Dataset.write_to_npy
+    mmap_mode: str or None
+        passed on to np.load; by default the spectra are memory-mapped
+        read-only and stay on disk. Derived cubes, such as normalized
+        fluxes, are then written as new .npy files in the same directory.
+
+    Returns
+    -------
+    ds: Dataset
+    """
+    arrays = {}
+    for name in NPY_ARRAYS:
+        path = os.path.join(directory, "%s.npy" % name)
+        if os.path.exists(path):
+            arrays[name] = np.load(path, mmap_mode=mmap_mode)
+        else:
+            arrays[name] = None
+    ds = Dataset(arrays["wl"], arrays["tr_ID"], arrays["tr_flux"],
+                 arrays["tr_ivar"], arrays["tr_label"], arrays["tr_delta"],
+                 arrays["test_ID"], arrays["test_flux"], arrays["test_ivar"],
+                 None, None)
+    ds.ranges = arrays["ranges"]
+    if mmap_mode is not None:
+        ds.storage = directory
+    return ds
+
+
 def convert_to_hdulist(ds):
     """ transform TheCannon dataset into fits HDU list """
     print('@Bo Zhang: ---------------------------------------------------')
@@ -37,6 +37,12 @@ def _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars):
 def _find_contpix(wl, fluxes, ivars, target_frac):
     """ Find continuum pix in spec, meeting a set target fraction
 
+    The cuts f_cut = sig_cut are raised in steps of 0.0001 from 0.0001
+    until the target fraction is met. A pixel passes both cuts when
+    max(|fbar-1|, f_sig) is below them, so the smallest passing step is
+    found directly from the sorted scores, with the statistics computed
+    once.
+
     Parameters
     ----------
     wl: numpy ndarray
@@ -61,22 +67,45 @@ def _find_contpix(wl, fluxes, ivars, target_frac):
     bad2 = np.var(ivars, axis=0) == 0
     bad = np.logical_and(bad1, bad2)
     npixels = len(wl)-sum(bad)
-    f_cut = 0.0001
     stepsize = 0.0001
-    sig_cut = 0.0001
-    contmask = _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars)
+
+    f_bar = np.median(fluxes, axis=0)
+    sigma_f = np.var(fluxes, axis=0)
+    scores = np.maximum(np.abs(f_bar-1), sigma_f)
+    scores[np.logical_and(f_bar==0, sigma_f==0)] = np.inf
+    sorted_scores = np.sort(scores[np.isfinite(scores)])
+    # the smallest number of continuum pixels that meets the target; the
+    # ceiling of target_frac*npixels can be off by one either way, as the
+    # fraction is compared in floating point
+    nreq = None
+    first = max(int(np.ceil(target_frac*npixels)) - 1, 0)
+    for n in range(first, first + 3):
+        if npixels > 0 and n/float(npixels) >= target_frac:
+            nreq = n
+            break
+    if nreq is None or nreq > len(sorted_scores):
+        print("Warning: target frac cannot be met, "
+              "using all the candidate pixels.")
+        nreq = len(sorted_scores)
+    if nreq == 0:
+        threshold = 0.
+    else:
+        threshold = sorted_scores[nreq-1]
+    # the cuts are accumulated as in f_cut += stepsize, so that the
+    # step that passes is the same one that a stepwise search finds
+    nsteps = max(1, int(np.ceil(threshold/stepsize)) + 2)
+    if nsteps < 10**6:
+        cuts = np.add.accumulate(np.ones(nsteps)*stepsize)
+        f_cut = cuts[np.searchsorted(cuts, threshold)]
+    else:
+        f_cut = np.ceil(threshold/stepsize)*stepsize
+    sig_cut = f_cut
+    # the same mask as _find_contpix_given_cuts(f_cut, sig_cut, ...)
+    contmask = scores <= f_cut
     if npixels > 0:
         frac = sum(contmask)/float(npixels)
     else:
         frac = 0
-    while (frac < target_frac): 
-        f_cut += stepsize
-        sig_cut += stepsize
-        contmask = _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars)
-        if npixels > 0:
-            frac = sum(contmask)/float(npixels)
-        else:
-            frac = 0
     if frac > 0.10*npixels:
         print("Warning: Over 10% of pixels identified as continuum.")
     print("%s out of %s pixels identified as continuum" %(sum(contmask), 
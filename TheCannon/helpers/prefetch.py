@@ -0,0 +1,45 @@
+""" Read many files with a few threads, a bounded number ahead """
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+__all__ = ['prefetch_map']
+
+
+def prefetch_map(func, items, n_threads=8, prefetch=None):
+    """ Like map(func, items), evaluated by a pool of threads
+
+    At most `prefetch` calls are in flight or finished but not yet
+    consumed, so memory stays bounded however many items there are.
+    The results are returned in the order of items. This pays off when
+    func waits on I/O, e.g. opening files.
+
+    Parameters
+    ----------
+    func: callable
+        function of one item
+    items: iterable
+        the items
+    n_threads: int
+        number of threads
+    prefetch: int, optional
+        number of calls ahead of the consumer; by default 2*n_threads
+
+    Returns
+    -------
+    generator of func(item)
+    """
+    if prefetch is None:
+        prefetch = 2 * n_threads
+    pool = ThreadPool(n_threads)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,39 @@
+""" Signal-to-noise ratios of spectra """
+
+import numpy as np
+
+__all__ = ['median_SNR']
+
+
+def median_SNR(fluxes, ivars, take):
+    """ Median of flux*ivar**0.5 over the pixels take, for every spectrum
+
+    Parameters
+    ----------
+    fluxes, ivars: numpy ndarray of shape (nstars, npixels)
+        pixel intensities and inverse variances
+    take: numpy ndarray of bools, shape (nstars, npixels)
+        the good pixels
+
+    Returns
+    -------
+    SNR: numpy ndarray of length nstars
+        NaN where there are no good pixels, or a NaN among them, as in
+        np.median
+    """
+    with np.errstate(invalid='ignore'):
+        snr = np.asarray(fluxes, dtype=np.float64) \
+                * np.asarray(ivars, dtype=np.float64)**0.5
+    # a NaN among the good pixels makes the median NaN
+    poisoned = np.any(take & np.isnan(snr), axis=1)
+    # the bad pixels are sorted to the end of each row, after the
+    # ngood good ones, whose median is read off the middle
+    snr[~take] = np.nan
+    snr.sort(axis=1)
+    ngood = np.sum(take, axis=1)
+    lo = np.maximum((ngood - 1) // 2, 0)[:, None]
+    hi = np.maximum(ngood // 2, 0)[:, None]
+    median = (np.take_along_axis(snr, lo, axis=1) +
+              np.take_along_axis(snr, hi, axis=1))[:, 0] / 2.
+    median[(ngood == 0) | poisoned] = np.nan
+    return median
@@ -1,57 +1,157 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 
-from scipy import optimize as opt
 import numpy as np
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 from TheCannon import train_model
+from .label_fit import _get_model_spectra, _fit_labels
 
-def _get_lvec(labels):
-    """
-    Constructs a label vector for an arbitrary number of labels
-    Assumes that our model is quadratic in the labels
+# model shared with the worker processes of _infer_labels, set once per
+# worker by _init_worker
+_worker_model = {}
+
+
+def _get_linear_guess(coeffs, fluxes, weights, bound=5.):
+    """ Closed-form starting labels for a batch of stars
+
+    The model is linear in the label vector, so treating every linear and
+    quadratic term as a free parameter gives a weighted linear least-squares
+    problem, which is solved for all stars at once. The linear terms of the
+    solution are the starting labels. This is a cheap starting point, not
+    necessarily a better one than a fixed start, so it is used alongside
+    other starting points rather than instead of them.
 
     Parameters
     ----------
-    labels: numpy ndarray
-        pivoted label values for one star
+    coeffs: numpy ndarray, shape (npix, nterms)
+        the coefficients on each element of the label vector
+    fluxes: numpy ndarray, shape (nstars, npix)
+        pixel intensities
+    weights: numpy ndarray, shape (nstars, npix)
+        inverse variances of the residuals
+    bound: float
+        the starting labels are clipped to [-bound, bound], in units of the
+        label scales
 
     Returns
     -------
-    lvec: numpy ndarray
-        label vector
+    labels_0: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled starting labels
     """
-    nlabels = len(labels)
-    # specialized to second-order model
-    linear_terms = labels 
-    quadratic_terms = np.outer(linear_terms, 
-                               linear_terms)[np.triu_indices(nlabels)]
-    lvec = np.hstack((linear_terms, quadratic_terms))
-    return lvec
-
-
-def _func(coeffs, *labels):
-    """ Takes the dot product of coefficients vec & labels vector 
-    
+    nterms = coeffs.shape[1]
+    nlabels = int(round((np.sqrt(8 * nterms + 1) - 3) / 2))
+    terms = coeffs[:, 1:]
+    nfree = terms.shape[1]
+    prods, triu = train_model._get_lvec_products(terms)
+    ATA = np.zeros((len(fluxes), nfree, nfree))
+    ATA_triu = np.dot(weights, prods)
+    ATA[:, triu[0], triu[1]] = ATA_triu
+    ATA[:, triu[1], triu[0]] = ATA_triu
+    ATb = np.dot(weights * (fluxes - coeffs[:, 0]), terms)
+    # a little ridge keeps degenerate terms from blowing up the solve
+    ridge = 1e-10 * np.trace(ATA, axis1=1, axis2=2) / nfree
+    ATA += ridge[:, None, None] * np.eye(nfree)
+    params = np.linalg.solve(ATA, ATb[:, :, None])[:, :, 0]
+    return np.clip(params[:, :nlabels], -bound, bound)
+
+
+def _infer_labels_chunk(coeffs_all, scatters, flux, ivar, starting_guesses,
+                        prune_factor):
+    """
+    Fits the labels of one chunk of test stars
+
     Parameters
     ----------
-    coeffs: numpy ndarray
-        the coefficients on each element of the label vector
-
-    *labels: numpy ndarray
-        label vector
+    coeffs_all, scatters: numpy ndarray
+        the model
+    flux, ivar: numpy ndarray, shape (nstars, npix)
+        test spectra of the chunk
+    starting_guesses: numpy ndarray, shape (nguesses, nlabels), or None
+        starting points; None for the closed-form guess of each star
+        and the all-ones start, in that order
+    prune_factor: float or None
+        see _infer_labels
 
     Returns
     -------
-    dot product of coeffs vec and labels vec
+    labels, errs: numpy ndarray, shape (nstars, nguesses, nlabels)
+        pivoted and scaled labels and their variances, for every candidate
+    chisq: numpy ndarray, shape (nstars, nguesses)
+    converged: numpy ndarray of bool, shape (nstars, nguesses)
+        True where the fit converged; the other candidates hold the best
+        labels found
+    pruned: numpy ndarray of bool, shape (nstars, nguesses)
+        True for candidates dropped by prune_factor, which hold their
+        last labels
+    nfailed: int
+        number of stars for which no candidate could be fit
     """
-    lvec = _get_lvec(list(labels))
-    return np.dot(coeffs, lvec)
+    flux = np.array(flux, dtype=float)
+    ivar = np.array(ivar, dtype=float)
+    nstars = len(flux)
+    nterms = coeffs_all.shape[1]
+    nlabels = int(round((np.sqrt(8 * nterms + 1) - 3) / 2))
+    nguesses = 2 if starting_guesses is None else len(starting_guesses)
+
+    # where the ivar == 0, set the normalized flux to 1 and the sigma to 100
+    bad = ivar == 0
+    flux[bad] = 1.0
+    sigma2 = np.ones(ivar.shape) * 100.0**2
+    sigma2[~bad] = 1.0 / ivar[~bad]
+    weights = 1.0 / (sigma2 + scatters**2)
+
+    if starting_guesses is None:
+        labels_0 = np.stack([_get_linear_guess(coeffs_all, flux, weights),
+                             np.ones((nstars, nlabels))], axis=1)
+        labels_0 = labels_0.reshape(nstars * nguesses, nlabels)
+    else:
+        labels_0 = np.tile(starting_guesses, (nstars, 1))
+    # each star is repeated once per starting point
+    flux = np.repeat(flux, nguesses, axis=0)
+    labels, covs, chisq, converged, pruned = _fit_labels(
+            coeffs_all, flux, np.repeat(weights, nguesses, axis=0),
+            labels_0, ncandidates=nguesses, prune_factor=prune_factor)
+    # the fit is undefined where the starting chisq is not finite
+    failed = ~np.isfinite(chisq)
+    nfailed = np.sum(np.all(failed.reshape(-1, nguesses), axis=1))
+    labels[failed] = -9999.
+    covs[failed] = -9999.
+    resids = flux - _get_model_spectra(coeffs_all, labels)
+    chi2 = resids**2 * np.repeat(
+            ivar / (1 + ivar * scatters**2), nguesses, axis=0)
+    shape = (nstars, nguesses)
+    return (labels.reshape(shape + (nlabels, )),
+            np.diagonal(covs, axis1=1, axis2=2).reshape(shape + (nlabels, )),
+            np.sum(chi2, axis=1).reshape(shape), converged.reshape(shape),
+            pruned.reshape(shape), nfailed)
 
 
-def _infer_labels(model, dataset, starting_guess=None):
+def _init_worker(coeffs_all, scatters, starting_guesses, prune_factor):
+    """ Ships the model to a worker process, once """
+    _worker_model['args'] = (coeffs_all, scatters)
+    _worker_model['kwargs'] = (starting_guesses, prune_factor)
+
+
+def _infer_labels_worker(chunk):
+    """ Runs _infer_labels_chunk on a chunk of (flux, ivar) in a worker """
+    coeffs_all, scatters = _worker_model['args']
+    starting_guesses, prune_factor = _worker_model['kwargs']
+    flux, ivar = chunk
+    return _infer_labels_chunk(coeffs_all, scatters, flux, ivar,
+                               starting_guesses, prune_factor)
+
+
+def _infer_labels(model, dataset, starting_guess=None, chunk_size=256,
+                  prune_factor=2., return_candidates=False, n_jobs=1):
     """
     Uses the model to solve for labels of the test set.
 
+    The test stars are fit in chunks of chunk_size stars, all stars of a
+    chunk at once. Several starting points can be given; they are then
+    all fit in the same pass, and the candidate with the lowest chisq is
+    kept for each star. With n_jobs > 1, the chunks are spread over a
+    pool of worker processes, which receive the model once.
+
     Parameters
     ----------
     model: tuple
@@ -60,63 +160,110 @@ def _infer_labels(model, dataset, starting_guess=None):
     dataset: Dataset
         Dataset that needs label inference
 
+    starting_guess: numpy ndarray, optional
+        starting point of the fit, in pivoted and scaled label space;
+        either of shape (nlabels, ) or (nguesses, nlabels). By default,
+        each star is fit from two starting points: the closed-form
+        solution of the linearized problem, see _get_linear_guess, and
+        all ones.
+
+    chunk_size: int
+        number of fits (stars times starting points) done together
+
+    prune_factor: float or None
+        stop optimizing a candidate once its chisq is more than
+        prune_factor times the best chisq of the same star
+
+    return_candidates: bool
+        also return the results for every starting point
+
+    n_jobs: int
+        number of worker processes
+
     Returns
     -------
     errs_all:
         Covariance matrix of the fit
+    chisq_all:
+        chisq of the best fit
+    cand_labels, cand_errs, cand_chisq, cand_pruned: (if return_candidates)
+        labels, errors and chisq for every starting point, with shapes
+        (nguesses, nstars, nlabels), (nguesses, nstars, nlabels) and
+        (nguesses, nstars), and a mask of shape (nguesses, nstars) of
+        the candidates dropped by prune_factor. Dropped candidates hold
+        their last labels and chisq; candidates that did not converge
+        hold the best labels found. Only fits that could not be started
+        at all have scaled labels of -9999. Whether the kept fit of each
+        star converged is in dataset.test_label_converged.
     """
     print("Inferring Labels")
     coeffs_all = model.coeffs
     scatters = model.scatters
     #chisqs = model.chisqs
-    nlabels = len(dataset.get_plotting_labels())
+    nlabels = len(model.pivots)
     fluxes = dataset.test_flux
     ivars = dataset.test_ivar
     nstars = fluxes.shape[0]
-    labels_all = np.zeros((nstars, nlabels))
-    MCM_rotate_all = np.zeros((nstars, coeffs_all.shape[1] - 1,
-                               coeffs_all.shape[1]-1))
-    errs_all = np.zeros((nstars, nlabels))
-    chisq_all = np.zeros(nstars)
-    scales = model.scales
 
-    if starting_guess == None:
-        starting_guess = np.ones(nlabels)
+    if starting_guess is None:
+        starting_guesses = None
+        nguesses = 2
+    else:
+        starting_guesses = np.atleast_2d(starting_guess)
+        nguesses = len(starting_guesses)
+    cand_labels = np.zeros((nguesses, nstars, nlabels))
+    cand_errs = np.zeros((nguesses, nstars, nlabels))
+    cand_chisq = np.zeros((nguesses, nstars))
+    cand_converged = np.zeros((nguesses, nstars), dtype=bool)
+    cand_pruned = np.zeros((nguesses, nstars), dtype=bool)
+    nfailed = 0
 
     # print("starting guess: %s" %starting_guess)
-    for jj in range(nstars):
-        flux = fluxes[jj,:]
-        ivar = ivars[jj,:]
-        
-
-        # where the ivar == 0, set the normalized flux to 1 and the sigma to 100
-        bad = ivar == 0
-        flux[bad] = 1.0
-        sigma = np.ones(ivar.shape) * 100.0
-        sigma[~bad] = np.sqrt(1.0 / ivar[~bad])
-
-        flux_piv = flux - coeffs_all[:,0] * 1.  # pivot around the leading term
-        errbar = np.sqrt(sigma**2 + scatters**2)
-        coeffs = np.delete(coeffs_all, 0, axis=1)  # take pivot into account
-        
-        try:
-            labels, covs = opt.curve_fit(_func, coeffs, flux_piv,
-                                         p0 = starting_guess,
-                                         sigma=errbar, absolute_sigma=True)
-        except RuntimeError:
-            print("Error - curve_fit failed")
-            labels = np.zeros(starting_guess.shape)-9999.
-            covs = np.zeros((len(starting_guess),len(starting_guess)))-9999.
-        chi2 = (flux_piv-_func(coeffs, *labels))**2 * ivar / (1 + ivar * scatters**2)
-        chisq_all[jj] = sum(chi2)
-        labels_all[jj,:] = model.scales * labels + model.pivots
-        errs_all[jj,:] = covs.diagonal()
-
-    dataset.set_test_label_vals(labels_all)
+    chunk_stars = max(1, chunk_size // nguesses)
+    starts = range(0, nstars, chunk_stars)
+    chunks = ((fluxes[start:start+chunk_stars], ivars[start:start+chunk_stars])
+              for start in starts)
+    pool = None
+    if n_jobs == 1:
+        results = (_infer_labels_chunk(coeffs_all, scatters, flux, ivar,
+                                       starting_guesses, prune_factor)
+                   for flux, ivar in chunks)
+    else:
+        pool = mp.Pool(processes=n_jobs, initializer=_init_worker,
+                       initargs=(coeffs_all, scatters, starting_guesses,
+                                 prune_factor))
+        # imap hands out the chunks lazily, and returns them in order
+        results = pool.imap(_infer_labels_worker, chunks)
+    try:
+        for start, result in zip(starts, results):
+            labels, errs, chisq, converged, pruned, nfailed_chunk = result
+            stop = start + len(chisq)
+            cand_labels[:, start:stop] = (model.scales * labels + model.pivots
+                    ).transpose(1, 0, 2)
+            cand_errs[:, start:stop] = errs.transpose(1, 0, 2)
+            cand_chisq[:, start:stop] = chisq.T
+            cand_converged[:, start:stop] = converged.T
+            cand_pruned[:, start:stop] = pruned.T
+            nfailed += nfailed_chunk
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if nfailed > 0:
+        print("Error - label fit failed for %s stars" % nfailed)
+    best = np.argmin(cand_chisq, axis=0)
+    stars = np.arange(nstars)
+    labels_all = cand_labels[best, stars]
+    errs_all = cand_errs[best, stars]
+    chisq_all = cand_chisq[best, stars]
+    converged_all = cand_converged[best, stars]
+    if not np.all(converged_all):
+        print("Warning - label fit did not converge for %s stars; "
+              "their best labels so far are kept" % np.sum(~converged_all))
+
+    dataset.set_test_label_vals(labels_all, converged_all)
+    if return_candidates:
+        return errs_all, chisq_all, cand_labels, cand_errs, cand_chisq, \
+                cand_pruned
     return errs_all, chisq_all
-    
-    
-    
-    
-    
-    
\ No newline at end of file
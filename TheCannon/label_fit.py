@@ -0,0 +1,362 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+import numpy as np
+from scipy import optimize as opt
+
+
+_quadratic_indices = {}
+
+
+def _get_quadratic_indices(nlabels):
+    """
+    Label indices (i, j), i <= j, of the quadratic terms of the label vector
+
+    These are computed once per number of labels and reused.
+    """
+    if nlabels not in _quadratic_indices:
+        _quadratic_indices[nlabels] = np.triu_indices(nlabels)
+    return _quadratic_indices[nlabels]
+
+
+def _get_lvec(label_vals, pivots, scales, derivs, structured=False):
+    """
+    Constructs a label vector for an arbitrary number of labels
+    Assumes that our model is quadratic in the labels
+
+    Parameters
+    ----------
+    label_vals: numpy ndarray, shape (nstars, nlabels)
+        labels 
+    pivots: numpy ndarray, shape (nlabels, )
+        offset we subtract from the label_vals
+    scales: numpy ndarray, shape (nlabels, )
+        scale we divide out of the label_vals
+    derivs: return also the derivatives of the vector wrt the labels
+    structured: if derivs, return the derivatives in structured form,
+        i.e. as the scaled label offsets they are built from, instead of
+        as a dense (nstars, nterms, nlabels) array. Use _lvec_derivs_dot
+        to contract them with coefficients.
+
+    Returns
+    -------
+    lvec: numpy ndarray
+        label vector
+    dlvec_dl: numpy ndarray (if derivs)
+        label vector derivatives
+        
+    Notes
+    --------
+    lvec_derivs and lvec is now in units of the scaled labels! 
+    """
+    if len(label_vals.shape) == 1:
+        label_vals = np.array([label_vals])
+    nlabels = label_vals.shape[1]
+    nstars = label_vals.shape[0]
+    # specialized to second-order model
+    ii, jj = _get_quadratic_indices(nlabels)
+    nquad = len(ii)
+    linear_offsets = (label_vals - pivots[None, :]) / scales[None, :]
+    lvec = np.empty((nstars, 1 + nlabels + nquad))
+    lvec[:, 0] = 1.
+    lvec[:, 1:1+nlabels] = linear_offsets
+    np.multiply(linear_offsets[:, ii], linear_offsets[:, jj],
+                out=lvec[:, 1+nlabels:])
+    if not derivs:
+        return lvec
+    if structured:
+        return lvec, linear_offsets
+    lvec_derivs = np.zeros((nstars, 1 + nlabels + nquad, nlabels))
+    lvec_derivs[:, 1 + np.arange(nlabels), np.arange(nlabels)] = 1.
+    quad = 1 + nlabels + np.arange(nquad)
+    lvec_derivs[:, quad, ii] = linear_offsets[:, jj]
+    lvec_derivs[:, quad, jj] += linear_offsets[:, ii]
+    
+    return lvec, lvec_derivs
+
+
+def _get_quadratic_coeff_matrix(coeffs, nlabels):
+    """
+    Splits coefficients into linear terms and a symmetric quadratic matrix
+
+    The model coeffs . lvec is then
+    coeffs[..., 0] + lin . x + 0.5 * x . quad . x
+    for scaled label offsets x.
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray, shape (..., nterms)
+        coefficients on each element of the label vector
+    nlabels: int
+        number of labels
+
+    Returns
+    -------
+    lin: numpy ndarray, shape (..., nlabels)
+        linear coefficients
+    quad: numpy ndarray, shape (..., nlabels, nlabels)
+        second derivatives of the model wrt the scaled labels
+    """
+    ii, jj = _get_quadratic_indices(nlabels)
+    quad = np.zeros(coeffs.shape[:-1] + (nlabels, nlabels))
+    quad[..., ii, jj] = coeffs[..., 1+nlabels:]
+    quad[..., jj, ii] += coeffs[..., 1+nlabels:]
+    return coeffs[..., 1:1+nlabels], quad
+
+
+def _take(arr, inds):
+    """ Rows inds of arr, or None if arr is None """
+    if arr is None:
+        return None
+    return arr[inds]
+
+
+def _get_model_spectra(coeffs, labels):
+    """ Evaluates the quadratic model for a batch of stars
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        the coefficients on each element of the label vector
+
+    labels: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled label values
+
+    Returns
+    -------
+    model spectra, numpy ndarray of shape (nstars, npix)
+    """
+    nlabels = labels.shape[1]
+    lvec = _get_lvec(
+            labels, np.zeros(nlabels), np.ones(nlabels), derivs=False)
+    return np.dot(lvec, coeffs.T)
+
+
+def _get_chisq(coeffs, fluxes, weights, labels, prior_mean, prior_ivar):
+    """ Weighted sum of squared residuals for a batch of stars
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        the coefficients on each element of the label vector
+    fluxes: numpy ndarray, shape (nstars, npix)
+        pixel intensities
+    weights: numpy ndarray, shape (nstars, npix)
+        inverse variances of the residuals
+    labels: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled label values
+    prior_mean, prior_ivar: numpy ndarray, shape (nstars, nlabels), or None
+        Gaussian prior on the labels
+
+    Returns
+    -------
+    chisq: numpy ndarray, shape (nstars, )
+    """
+    resids = fluxes - _get_model_spectra(coeffs, labels)
+    chisq = np.sum(weights * resids**2, axis=1)
+    if prior_ivar is not None:
+        chisq += np.sum(prior_ivar * (labels - prior_mean)**2, axis=1)
+    return chisq
+
+
+def _get_normal_equations(coeffs, quad_coeffs, fluxes, weights, labels,
+                          prior_mean, prior_ivar):
+    """ Gauss-Newton normal equations for a batch of stars
+
+    Uses the analytic Jacobian of the quadratic model, which is linear in
+    the labels: quad_coeffs is the output of
+    _get_quadratic_coeff_matrix(coeffs), computed once.
+
+    Returns
+    -------
+    chisq: numpy ndarray, shape (nstars, )
+        weighted sum of squared residuals
+    JTWJ: numpy ndarray, shape (nstars, nlabels, nlabels)
+        Gauss-Newton approximation to half the Hessian of chisq
+    JTWr: numpy ndarray, shape (nstars, nlabels)
+        minus half the gradient of chisq
+    """
+    resids = fluxes - _get_model_spectra(coeffs, labels)
+    wresids = weights * resids
+    chisq = np.sum(wresids * resids, axis=1)
+    lin, quad = quad_coeffs
+    npix, nlabels = lin.shape
+    jac = lin + np.dot(labels, quad.reshape(npix * nlabels, nlabels).T
+                       ).reshape(len(labels), npix, nlabels)
+    JTWJ = np.matmul(jac.transpose(0, 2, 1), weights[:, :, None] * jac)
+    JTWr = np.matmul(wresids[:, None, :], jac)[:, 0, :]
+    if prior_ivar is not None:
+        offsets = labels - prior_mean
+        chisq += np.sum(prior_ivar * offsets**2, axis=1)
+        JTWJ += prior_ivar[:, :, None] * np.eye(labels.shape[1])
+        JTWr -= prior_ivar * offsets
+    return chisq, JTWJ, JTWr
+
+
+def _fit_labels(coeffs, fluxes, weights, labels_0, prior_mean=None,
+                prior_ivar=None, max_iter=None, ftol=1.49012e-08,
+                xtol=1.49012e-08, ncandidates=1, prune_factor=None,
+                prune_after=5):
+    """ Levenberg-Marquardt fit of the labels of a batch of stars at once
+
+    Every iteration takes one damped Gauss-Newton step for all stars that
+    have not converged yet; stars drop out of later iterations as soon as
+    they converge.
+
+    The convergence tests follow MINPACK, as used by scipy's curve_fit, but
+    are made against the undamped Gauss-Newton step, so that a star whose
+    steps are only small because they are heavily damped keeps going. A
+    star converges when the actual reduction of chisq and the reduction
+    predicted for the undamped step are both at most ftol * chisq, with
+    a ratio of at most 2, or when the undamped step is smaller than xtol
+    times the labels. A star whose damping blows up without meeting
+    either test is not converged.
+
+    With ncandidates > 1, each group of ncandidates consecutive rows holds
+    the same star started from different points. After prune_after
+    iterations, a candidate whose chisq exceeds prune_factor times the
+    lowest chisq of its group stops being optimized; it keeps its last
+    labels and is flagged as pruned.
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        the coefficients on each element of the label vector
+    fluxes: numpy ndarray, shape (nstars, npix)
+        pixel intensities
+    weights: numpy ndarray, shape (nstars, npix)
+        inverse variances of the residuals
+    labels_0: numpy ndarray, shape (nstars, nlabels)
+        starting guess for the pivoted and scaled labels
+    prior_mean, prior_ivar: numpy ndarray, shape (nstars, nlabels), optional
+        Gaussian prior on the labels
+    max_iter: int, optional
+        maximum number of steps per star; by default 200 * (nlabels + 1),
+        the evaluation budget of scipy's curve_fit
+    ftol, xtol: float
+        relative tolerances on chisq and on the labels
+    ncandidates: int
+        number of starting points per star
+    prune_factor: float, optional
+        chisq ratio beyond which a candidate is dropped
+    prune_after: int
+        number of iterations before candidates are dropped
+
+    Returns
+    -------
+    labels: numpy ndarray, shape (nstars, nlabels)
+        best-fit labels; the best labels found for stars that did not
+        converge
+    covs: numpy ndarray, shape (nstars, nlabels, nlabels)
+        covariance matrices of the labels
+    chisq: numpy ndarray, shape (nstars, )
+        weighted sum of squared residuals at the best fit
+    converged: numpy ndarray of bool, shape (nstars, )
+        True where the fit converged
+    pruned: numpy ndarray of bool, shape (nstars, )
+        True for candidates that were dropped by prune_factor
+    """
+    nstars, nlabels = labels_0.shape
+    if max_iter is None:
+        max_iter = 200 * (nlabels + 1)
+    labels = np.array(labels_0, dtype=float)
+    quad_coeffs = _get_quadratic_coeff_matrix(coeffs, nlabels)
+    chisq, JTWJ, JTWr = _get_normal_equations(
+            coeffs, quad_coeffs, fluxes, weights, labels, prior_mean, prior_ivar)
+    damping = 1e-3 * np.ones(nstars)
+    converged = np.zeros(nstars, dtype=bool)
+    pruned = np.zeros(nstars, dtype=bool)
+    active = np.isfinite(chisq)
+    eye = np.eye(nlabels)
+    for it in range(max_iter):
+        stars = np.where(active)[0]
+        if len(stars) == 0:
+            break
+        diag = np.maximum(np.diagonal(JTWJ[stars], axis1=1, axis2=2), 1e-12)
+        # the undamped step and the reduction of chisq it predicts
+        lhs = JTWJ[stars] + (1e-12 * diag)[:, :, None] * eye
+        gn_step = np.linalg.solve(lhs, JTWr[stars][:, :, None])[:, :, 0]
+        gn_prered = np.sum(gn_step * JTWr[stars], axis=1)
+        small_step = np.all(np.abs(gn_step) <= xtol * (
+                np.abs(labels[stars]) + xtol), axis=1)
+        converged[stars[small_step]] = True
+        active[stars[small_step]] = False
+        stars = stars[~small_step]
+        diag = diag[~small_step]
+        gn_prered = gn_prered[~small_step]
+        if len(stars) == 0:
+            break
+
+        lhs = JTWJ[stars] + (damping[stars, None] * diag)[:, :, None] * eye
+        step = np.linalg.solve(lhs, JTWr[stars][:, :, None])[:, :, 0]
+        trial = labels[stars] + step
+        trial_chisq = _get_chisq(
+                coeffs, fluxes[stars], weights[stars], trial,
+                _take(prior_mean, stars), _take(prior_ivar, stars))
+        actred = chisq[stars] - trial_chisq
+        prered = 2. * np.sum(step * JTWr[stars], axis=1) - np.sum(
+                step * np.matmul(JTWJ[stars], step[:, :, None])[:, :, 0],
+                axis=1)
+        small_gain = np.logical_and.reduce([
+                np.abs(actred) <= ftol * chisq[stars],
+                gn_prered <= ftol * chisq[stars],
+                actred <= 2. * prered])
+        better = trial_chisq < chisq[stars]
+        # accepted steps: move and relax the damping
+        acc = stars[better]
+        if len(acc) > 0:
+            labels[acc] = trial[better]
+            chisq[acc], JTWJ[acc], JTWr[acc] = _get_normal_equations(
+                    coeffs, quad_coeffs, fluxes[acc], weights[acc], labels[acc],
+                    _take(prior_mean, acc), _take(prior_ivar, acc))
+            damping[acc] = np.maximum(damping[acc] / 10., 1e-12)
+        # rejected steps: increase the damping
+        rej = stars[~better]
+        damping[rej] *= 10.
+        converged[stars[small_gain]] = True
+        active[stars[small_gain]] = False
+        # a star whose steps cannot lower chisq even when heavily damped,
+        # without being at a minimum, is given up
+        stuck = rej[damping[rej] > 1e10]
+        active[stuck] = False
+        if ncandidates > 1 and prune_factor is not None and it >= prune_after:
+            best = np.repeat(
+                    np.min(chisq.reshape(-1, ncandidates), axis=1),
+                    ncandidates)
+            losing = np.logical_and(active, chisq > prune_factor * best)
+            active[losing] = False
+            pruned[losing] = True
+    converged = np.logical_and(converged, np.isfinite(chisq))
+    finite = np.isfinite(chisq)
+    covs = np.zeros((nstars, nlabels, nlabels))
+    covs[finite] = np.linalg.pinv(JTWJ[finite])
+    return labels, covs, chisq, converged, pruned
+
+
+def test_fit_labels(coeffs, fluxes, weights, labels_0, ftol=1.49012e-08):
+    '''
+    this checks _fit_labels against scipy's curve_fit, star by star,
+    from the same starting labels; the arguments are as in _fit_labels
+    '''
+    labels, covs, chisq, converged, pruned = _fit_labels(
+            coeffs, fluxes, weights, labels_0, ftol=ftol)
+    nlabels = labels_0.shape[1]
+    ok = True
+    for jj in range(len(fluxes)):
+        def func(coeffs, *labels):
+            return _get_model_spectra(coeffs, np.array([labels]))[0]
+        try:
+            labels_cf, covs_cf = opt.curve_fit(
+                    func, coeffs, fluxes[jj], p0=labels_0[jj],
+                    sigma=1. / np.sqrt(weights[jj]), absolute_sigma=True,
+                    ftol=ftol)
+        except RuntimeError:
+            print(jj, "curve_fit failed")
+            continue
+        chisq_cf = _get_chisq(coeffs, fluxes[jj:jj+1], weights[jj:jj+1],
+                              labels_cf[None, :], None, None)[0]
+        shifts = (labels[jj] - labels_cf) / np.sqrt(np.diagonal(covs[jj]))
+        worse = chisq[jj] - chisq_cf > 2. * ftol * chisq_cf
+        ok = ok and converged[jj] and not worse
+        if worse or not converged[jj]:
+            print(jj, converged[jj], chisq[jj], chisq_cf, shifts)
+    return ok
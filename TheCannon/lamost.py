@@ -3,7 +3,6 @@
 from __future__ import (absolute_import, division, print_function,)
 import numpy as np
 import scipy.optimize as opt
-from scipy import interpolate 
 import os
 import sys
 import matplotlib.pyplot as plt
@@ -20,6 +19,9 @@ try:
 except ImportError:
     import pyfits
 
+from .helpers.snr import median_SNR
+from .helpers.prefetch import prefetch_map
+
 def get_pixmask(file_in, wl, middle, flux, ivar):
     """ Return a mask array of bad pixels for one object's spectrum
 
@@ -76,10 +78,83 @@ def get_pixmask(file_in, wl, middle, flux, ivar):
     return bad_pix_a
 
 
-def load_spectra(filenames, input_grid=None):
+def _read_spectrum(fits_file):
+    """ Reads the wavelengths, flux, ivar and redshift of a lamost fits
+    file, and closes it """
+    with pyfits.open(fits_file) as file_in:
+        wl = np.array(file_in[0].data[2])
+        flux = np.array(file_in[0].data[0])
+        ivar = np.array((file_in[0].data[1]))
+        redshift = file_in[0].header['Z']
+    return wl, flux, ivar, redshift
+
+
+def _get_resampler(xs, grid):
+    """ Linear interpolation from the points xs onto grid, for many spectra
+
+    Every spectrum has its own points, e.g. its own redshift; the segment
+    of each grid point is found for all of them at once. Gives the same
+    result as scipy.interpolate.interp1d(x, y)(grid) for each row,
+    including its ValueError for grid points outside of x.
+
+    Parameters
+    ----------
+    xs: numpy ndarray, shape (nspectra, nx)
+        the points of each spectrum
+    grid: numpy ndarray
+        the points to interpolate to
+
+    Returns
+    -------
+    resample: function
+        resample(ys) interpolates the rows of ys, of shape (nspectra, nx)
+    """
+    nspectra, nx = xs.shape
+    order = None
+    if np.any(np.diff(xs, axis=1) < 0):
+        order = np.argsort(xs, axis=1)
+        xs = np.take_along_axis(xs, order, axis=1)
+    if np.any(grid[None, :] < xs[:, :1]):
+        raise ValueError("A value in x_new is below the interpolation range.")
+    if np.any(grid[None, :] > xs[:, -1:]):
+        raise ValueError("A value in x_new is above the interpolation range.")
+    # np.searchsorted(x, grid) for all the rows at once: each point of x
+    # is placed on the (shared) grid, and the points below each grid point
+    # are counted
+    grid_order = None
+    if np.any(np.diff(grid) < 0):
+        grid_order = np.argsort(grid)
+        grid = grid[grid_order]
+    pos = np.searchsorted(grid, xs, side='right')
+    pos += (len(grid) + 1) * np.arange(nspectra)[:, None]
+    counts = np.bincount(pos.ravel(), minlength=nspectra*(len(grid)+1))
+    hi = counts.reshape(nspectra, -1)[:, :-1].cumsum(axis=1)
+    if grid_order is not None:
+        hi[:, grid_order] = hi.copy()
+        grid[grid_order] = grid.copy()
+    # indices into the flattened rows
+    hi = hi.clip(1, nx-1) + nx * np.arange(nspectra)[:, None]
+    lo = hi - 1
+    x_lo = xs.ravel()[lo]
+    dx = xs.ravel()[hi] - x_lo
+    t = grid - x_lo
+    def resample(ys):
+        if order is not None:
+            ys = np.take_along_axis(ys, order, axis=1)
+        ys = ys.ravel()
+        y_lo = ys[lo]
+        return (ys[hi] - y_lo) / dx * t + y_lo
+    return resample
+
+
+def load_spectra(filenames, input_grid=None, n_threads=8, batch_size=256):
     """
     Extracts spectra (wavelengths, fluxes, fluxerrs) from lamost fits files
 
+    The files are read by a pool of threads. The spectra are resampled
+    onto the grid in batches of spectra with the same number of pixels,
+    whatever their redshifts.
+
     Parameters
     ----------
     filenames: np ndarray
@@ -88,6 +163,12 @@ def load_spectra(filenames, input_grid=None):
     input_grid: np ndarray
         grid onto which to interpolate
 
+    n_threads: int
+        number of files read at the same time
+
+    batch_size: int
+        number of spectra held back to be resampled together
+
     Returns
     -------
     wl: numpy ndarray of length npixels
@@ -110,11 +191,10 @@ def load_spectra(filenames, input_grid=None):
 
     if input_grid is None:
         # use first file as template
-        file_in = pyfits.open(filenames[0]) 
-        grid_all = np.array(file_in[0].data[2])
+        with pyfits.open(filenames[0]) as file_in:
+            grid_all = np.array(file_in[0].data[2])
         middle = np.logical_and(grid_all > 3905, grid_all < 9000)
         grid = grid_all[middle]
-        file_in.close()
 
     else:
         grid = input_grid
@@ -125,23 +205,35 @@ def load_spectra(filenames, input_grid=None):
     fluxes = np.zeros((nstars, npixels), dtype=float)
     ivars = np.zeros(fluxes.shape, dtype=float)
 
-    for jj, fits_file in enumerate(filenames):
-        file_in = pyfits.open(fits_file)
-        wl = np.array(file_in[0].data[2])
-        flux = np.array(file_in[0].data[0])
-        ivar = np.array((file_in[0].data[1]))
-        npix[jj] = sum(ivar>0)
+    batches = {}
+    def flush(key):
+        rows, wl, redshift, flux, ivar = zip(*batches.pop(key))
+        rows = np.array(rows)
+        wl = np.array(wl)
+        redshift = np.array(redshift)[:, None]
+        flux = np.array(flux)
+        ivar = np.array(ivar)
         # SNR should be calculated ignoring bad pixels
-        SNRs[jj] = np.median(flux[ivar>0]*ivar[ivar>0]**0.5)
-        # correct for radial velocity of star
-        redshift = file_in[0].header['Z']
-        wl_shifted = wl - redshift * wl
-        # resample
-        flux_rs = (interpolate.interp1d(wl_shifted, flux))(grid)
-        ivar_rs = (interpolate.interp1d(wl_shifted, ivar))(grid)
+        SNRs[rows] = median_SNR(flux, ivar, ivar > 0)
+        # correct for radial velocity of star, and resample
+        resample = _get_resampler(wl - redshift * wl, grid)
+        fluxes[rows] = resample(flux)
+        ivar_rs = resample(ivar)
         ivar_rs[ivar_rs < 0] = 0. # in interpolating you can end up with neg
-        fluxes[jj,:] = flux_rs
-        ivars[jj,:] = ivar_rs
+        ivars[rows] = ivar_rs
+
+    spectra = prefetch_map(_read_spectrum, filenames, n_threads=n_threads)
+    nheld = 0
+    for jj, (wl, flux, ivar, redshift) in enumerate(spectra):
+        npix[jj] = sum(ivar>0)
+        batches.setdefault(len(wl), []).append((jj, wl, redshift, flux, ivar))
+        nheld += 1
+        if nheld == batch_size:
+            for key in list(batches):
+                flush(key)
+            nheld = 0
+    for key in list(batches):
+        flush(key)
 
     print("Spectra loaded")
     return grid, fluxes, ivars, npix, SNRs
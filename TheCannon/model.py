@@ -2,9 +2,13 @@ from .dataset import Dataset
 from .train_model import _train_model 
 from .train_model import _train_model_new
 from .train_model import _get_lvec
+from .train_model import _get_normal_sums, _solve_normal_sums
+from .train_model import _get_star_chisqs
+from .train_model import _regress_pixel_blocks
 from .infer_labels import _infer_labels
 from .helpers.corner import corner
 import numpy as np
+import json
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from copy import deepcopy
@@ -12,17 +16,45 @@ from copy import deepcopy
 plt.rc('text', usetex=True)
 plt.rc('font', family='serif')
 
+# model file format, see CannonModel.save
+_MAGIC = b"TheCannonModel\n"
+_FORMAT_VERSION = 1
+_ALIGN = 64
+_MODEL_ARRAYS = ['coeffs', 'scatters', 'scatter_precisions', 'pivots',
+                 'scales', 'wl', 'pixmask', 'star_chisqs', 'pixel_chisqs']
+
+
+def _aligned(nbytes):
+    """ nbytes rounded up to a multiple of _ALIGN """
+    return -(-nbytes // _ALIGN) * _ALIGN
+
+
 class CannonModel(object):
-    def __init__(self, order, useErrors):
+    def __init__(self, order, useErrors=False):
         self.coeffs = None
         self.scatters = None
+        self.scatter_precisions = None
+        # the full (npixels, nstars) chi squareds are only kept on request,
+        # see train; their sums over pixels and stars always are
         self.chisqs = None
+        self.star_chisqs = None
+        self.pixel_chisqs = None
+        self.chisq_outliers = None
         self.pivots = None
         self.scales = None
         self.new_tr_labels = None
         self.order = order
         self.model_spectra = None
         self.useErrors = useErrors
+        # wavelengths, label names and bad pixels of the model, recorded
+        # by train
+        self.wl = None
+        self.label_names = None
+        self.pixmask = None
+        # training stars of the dataset in the model, and the sums of their
+        # normal equations, kept by add_stars and remove_stars
+        self.tr_starmask = None
+        self._normal_sums = None
 
 
     def model(self):
@@ -33,19 +65,240 @@ class CannonModel(object):
             return self.coeffs
 
 
-    def train(self, ds):
-        """ Run training step: solve for best-fit spectral model """
+    def train(self, ds, chisqs_file=None, outlier_chisq=None, **kwargs):
+        """ Run training step: solve for best-fit spectral model
+
+        Parameters
+        ----------
+        ds: Dataset
+            the training set
+        chisqs_file: str, optional
+            .npy file to keep the chi squared of every pixel of every
+            training star in, as a memmap; otherwise only their sums per
+            star and per pixel are kept
+        outlier_chisq: float, optional
+            record every (pixel, star) with a larger chi squared in
+            chisq_outliers
+        kwargs:
+            with useErrors, passed on to _train_model_new, e.g. method,
+            max_iter and tol; chisqs_file and outlier_chisq are not
+            supported there
+        """
+        if self.useErrors:
+            self.coeffs, self.scatters, self.new_tr_labels, self.pivots, \
+                    self.scales, self.scatter_precisions, self.star_chisqs, \
+                    self.pixel_chisqs = _train_model_new(ds, **kwargs)
+        else:
+            self.coeffs, self.scatters, self.chisqs, self.pivots, self.scales, \
+                    self.scatter_precisions, self.star_chisqs, \
+                    self.pixel_chisqs, self.chisq_outliers = _train_model(
+                            ds, chisqs_file=chisqs_file,
+                            outlier_chisq=outlier_chisq)
+        self.wl = ds.wl
+        self.label_names = ds._label_names
+        self.tr_starmask = None
+        self._normal_sums = None
+        self._set_pixmask()
+
+
+    def _set_pixmask(self):
+        """ Flag the pixels where the regression failed """
+        self.pixmask = ~np.all(np.isfinite(self.coeffs), axis=1)
+        if self.scatter_precisions is not None:
+            self.pixmask |= np.isnan(self.scatter_precisions)
+
+
+    def add_stars(self, ds, stars, refit_scatters=False):
+        """ Add training stars of ds to the model, without retraining
+
+        At fixed scatters, the coefficients only depend on sums over the
+        training stars, so the contributions of the added stars are added
+        to these sums and the normal equations are solved again. The
+        pivots and scales of the labels are kept. star_chisqs then holds
+        the chi squareds of the stars in tr_starmask, in their order.
+
+        Parameters
+        ----------
+        ds: Dataset
+            the dataset the model was trained on
+        stars: numpy ndarray
+            indices, or boolean mask, of training stars of ds
+        refit_scatters: bool
+            also optimize the scatters again, starting from the current
+            ones; this needs all the training stars in the model
+        """
+        self._update_stars(ds, stars, True, refit_scatters)
+
+
+    def remove_stars(self, ds, stars, refit_scatters=False):
+        """ Remove training stars of ds from the model, without retraining
+
+        Same as add_stars, e.g. to drop the stars flagged by a cut on
+        star_chisqs and refit.
+
+        Parameters
+        ----------
+        ds: Dataset
+            the dataset the model was trained on
+        stars: numpy ndarray
+            indices, or boolean mask, of training stars of ds
+        refit_scatters: bool
+            also optimize the scatters again, starting from the current
+            ones; this needs all the training stars in the model
+        """
+        self._update_stars(ds, stars, False, refit_scatters)
+
+
+    def _update_stars(self, ds, stars, add, refit_scatters):
+        """ Add (add=True) or remove training stars, see add_stars """
+        self.model()
         if self.useErrors:
-            self.coeffs, self.scatters, self.new_tr_labels, self.chisqs, self.pivots, self.scales = _train_model_new(ds)
+            raise ValueError("stars cannot be added to or removed from a "
+                             "model trained with errors on the labels")
+        nstars = len(ds.tr_label)
+        if self.tr_starmask is None:
+            # the model was trained on all the training stars of ds
+            self.tr_starmask = np.ones(nstars, dtype=bool)
+        if self._normal_sums is None and not refit_scatters:
+            self._normal_sums = self._get_normal_sums(ds, self.tr_starmask)
+        stars = np.unique(np.arange(nstars)[stars])
+        stars = stars[self.tr_starmask[stars] != add]
+        if len(stars) == 0:
+            return
+        self.tr_starmask[stars] = add
+        if refit_scatters:
+            inds = np.where(self.tr_starmask)[0]
+            lvec = _get_lvec(ds.tr_label[inds], self.pivots, self.scales,
+                             derivs=False)
+            fluxes = ds.tr_flux[inds]
+            ivars = ds.tr_ivar[inds]
+            ivars = np.where(ivars < 0.01, 0.01, ivars)
+            fit = _regress_pixel_blocks(
+                    fluxes.swapaxes(0, 1), ivars.swapaxes(0, 1), lvec,
+                    scatters=self.scatters)
+            self.coeffs, self.scatters, self.scatter_precisions, \
+                    self.star_chisqs, self.pixel_chisqs = fit[:5]
+            self._normal_sums = self._get_normal_sums(ds, self.tr_starmask)
+        else:
+            sums = self._get_normal_sums(ds, stars)
+            sign = 1. if add else -1.
+            self._normal_sums = [total + sign * part for total, part
+                                 in zip(self._normal_sums, sums)]
+            self.coeffs, self.pixel_chisqs = _solve_normal_sums(
+                    *self._normal_sums)
+            inds = np.where(self.tr_starmask)[0]
+            lvec = _get_lvec(ds.tr_label[inds], self.pivots, self.scales,
+                             derivs=False)
+            self.star_chisqs = _get_star_chisqs(
+                    ds.tr_flux[inds], ds.tr_ivar[inds], lvec, self.coeffs,
+                    self.scatters)
+        # the full matrix of chi squareds is not kept up to date
+        self.chisqs = None
+        self._set_pixmask()
+
+
+    def _get_normal_sums(self, ds, stars):
+        """ _get_normal_sums for training stars of ds, at the model scatters """
+        lvec = _get_lvec(ds.tr_label[stars], self.pivots, self.scales,
+                         derivs=False)
+        return _get_normal_sums(ds.tr_flux[stars], ds.tr_ivar[stars], lvec,
+                                self.scatters)
+
+
+    def save(self, filename):
+        """ Write the model to a single file
+
+        The file holds a magic string, the length of a JSON header, the
+        header (format version, order, label names, and the dtype, shape
+        and offset of each array), and then the arrays, uncompressed and
+        aligned to 64 bytes, so that load can memory-map them.
+
+        Parameters
+        ----------
+        filename: str
+            the file to write
+        """
+        arrays = []
+        specs = {}
+        offset = 0
+        for name in _MODEL_ARRAYS:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            arr = np.ascontiguousarray(arr)
+            arrays.append(arr)
+            # offsets are counted from the start of the array data
+            specs[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape),
+                           'offset': offset}
+            offset += _aligned(arr.nbytes)
+        label_names = self.label_names
+        if label_names is not None:
+            label_names = [str(name) for name in label_names]
+        header = json.dumps({'format_version': _FORMAT_VERSION,
+                             'order': self.order,
+                             'useErrors': bool(self.useErrors),
+                             'label_names': label_names,
+                             'arrays': specs}).encode('utf-8')
+        start = len(_MAGIC) + 8 + len(header)
+        with open(filename, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(np.array(len(header), dtype='<u8').tobytes())
+            f.write(header)
+            f.write(b'\0' * (_aligned(start) - start))
+            for arr in arrays:
+                f.write(arr.tobytes())
+                f.write(b'\0' * (_aligned(arr.nbytes) - arr.nbytes))
+        print("Saved model as %s" % filename)
+
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """ Read a model written by save
+
+        Parameters
+        ----------
+        filename: str
+            the model file
+        mmap: bool
+            memory-map the arrays, read-only, instead of reading them
+
+        Returns
+        -------
+        model: CannonModel
+        """
+        with open(filename, 'rb') as f:
+            magic = f.read(len(_MAGIC))
+            if magic != _MAGIC:
+                raise ValueError("%s is not a Cannon model file" % filename)
+            nheader = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(nheader).decode('utf-8'))
+        if header['format_version'] > _FORMAT_VERSION:
+            raise ValueError("%s has model format version %s, this version "
+                             "of TheCannon reads up to %s" %
+                             (filename, header['format_version'],
+                              _FORMAT_VERSION))
+        if mmap:
+            data = np.memmap(filename, dtype=np.uint8, mode='r')
         else:
-            self.coeffs, self.scatters, self.chisqs, self.pivots, self.scales = _train_model(ds)
+            data = np.fromfile(filename, dtype=np.uint8)
+        start = _aligned(len(_MAGIC) + 8 + nheader)
+        model = cls(header['order'], header['useErrors'])
+        model.label_names = header['label_names']
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            first = start + spec['offset']
+            setattr(model, name,
+                    data[first:first+nbytes].view(dtype).reshape(shape))
+        return model
 
     def diagnostics(self):
         """ Produce a set of diagnostics plots about the model. """
         _model_diagnostics(self.dataset, self.model)
 
 
-    def infer_labels(self, ds, starting_guess = None):
+    def infer_labels(self, ds, starting_guess = None, **kwargs):
         """
         Uses the model to solve for labels of the test set, updates Dataset
         Then use those inferred labels to set the model.test_spectra attribute
@@ -54,13 +307,23 @@ class CannonModel(object):
         ----------
         ds: Dataset
             Dataset that needs label inference
+        starting_guess: ndarray, optional
+            Starting point(s) of the fit, of shape (nlabels, ) or
+            (nguesses, nlabels). Several starting points are fit in one
+            pass and the best one is kept for each star. By default,
+            the closed-form linearized solution and all ones.
+        kwargs:
+            passed on to infer_labels._infer_labels, e.g. return_candidates,
+            or n_jobs to fit the stars in several processes
 
         Returns
         -------
         errs_all: ndarray
             Covariance matrix of the fit
+        chisq_all: ndarray
+            chi squared of the fit
         """
-        return _infer_labels(self, ds, starting_guess)
+        return _infer_labels(self, ds, starting_guess, **kwargs)
 
 
     def infer_spectra(self, ds):
@@ -223,13 +486,13 @@ class CannonModel(object):
         pivots = self.pivots
         npixels = len(lams)
         nlabels = len(pivots)
-        chisqs = self.chisqs
+        star_chisqs = self.star_chisqs
         coeffs = self.coeffs
         scatters = self.scatters
 
         # Histogram of the chi squareds of ind. stars
-        plt.hist(np.sum(chisqs, axis=0), color='lightblue', alpha=0.7,
-                bins=np.sqrt(len(chisqs)))
+        plt.hist(star_chisqs, color='lightblue', alpha=0.7,
+                bins=int(np.sqrt(len(star_chisqs))))
         dof = len(lams) - coeffs.shape[1]   # for one star
         plt.axvline(x=dof, c='k', linewidth=2, label="DOF")
         plt.legend()
@@ -242,5 +505,5 @@ class CannonModel(object):
         plt.close()
 
     # convenient namings to match existing packages
-    predict = _infer_labels
+    predict = infer_labels
     fit = train
@@ -4,11 +4,20 @@ import matplotlib.pyplot as plt
 from .helpers.compatibility import range, map
 from .helpers.corner import corner
 import scipy.optimize as op
+from .label_fit import (_get_quadratic_indices, _get_lvec,
+                        _get_quadratic_coeff_matrix, _fit_labels)
 
-def training_step_objective_function(pars, fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales):
+def training_step_objective_function(pars, fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales, buffers=None):
     """
     This is just for a single lambda.
     ldelta is scaled like the linear lvec components
+
+    The residual-weighted terms are contracted over the pixels before the
+    derivatives of the label vector come in, so apart from fluxes and ivars
+    only three (Npix, Nstars) arrays are needed; they are taken from
+    buffers, and stored there, to be reused by the next evaluation. The
+    arithmetic is done in the dtype of fluxes, e.g. float32, with sums
+    accumulated in float64.
     """
     # OLD CODE!
     '''coeff_m = pars[:-1]
@@ -33,56 +42,78 @@ def training_step_objective_function(pars, fluxes, ivars, labels_0, ldelta, Nsta
     
     # flat parameter array     
     coeff, scatter, labels = unpack(pars, Npix, Nlabels, Nstars, nlabels)
+    dtype = fluxes.dtype
+    if buffers is None:
+        buffers = {}
+    if 'resids' not in buffers:
+        for name in ['resids', 'inv_var', 'weighted']:
+            buffers[name] = np.empty((Npix, Nstars), dtype=dtype)
+    resids = buffers['resids']
+    inv_var = buffers['inv_var']
+    weighted = buffers['weighted']
+    
+    lvec, linear_offsets = _get_lvec(labels, pivots, scales, derivs=True,
+                                     structured=True)
+    lvec = np.nan_to_num(lvec).astype(dtype)
     
-    lvec, lvec_derivs = _get_lvec(labels, pivots, scales, derivs=True)    
-    
-    #print(np.isnan(labels))
-   
     # second part of likleihood function (sum over k labels)        
     ldelta2 = ldelta**2 
-    #lnL_labels = np.nansum( -0.5 * (labels - lvec)** 2 / ldelta2) # - 0.5 * np.log(2. * np.pi * ldelta2) )
     lnL_labels = np.sum( -0.5 * (labels - labels_0)** 2 / ldelta2 - 0.5 * np.log(2. * np.pi * ldelta2) )
             
     # first part of likelihood function (sum over i pixels) 
-    inv_var = (ivars.T / (1. + ivars.T * scatter ** 2)).T
-    resids = fluxes - np.dot(coeff, lvec.T)
-    lnL_pixels = np.nansum( -0.5 * resids ** 2 * inv_var + 0.5 * (np.log(inv_var / (2. * np.pi))) )
+    np.dot(coeff.astype(dtype), lvec.T, out=resids)
+    np.subtract(fluxes, resids, out=resids)
+    np.multiply(ivars, (scatter**2)[:, None].astype(dtype), out=inv_var)
+    inv_var += 1.
+    np.divide(ivars, inv_var, out=inv_var)
+    np.multiply(inv_var, resids, out=weighted)
+    
+    # derivatives of likelihood function with respect to theta and vec(l);
+    # for the labels, contract over the pixels first: G = (w r)^T theta
+    dlnLdtheta = np.reshape(np.dot(weighted, lvec), (Npix * Nlabels,))
+    G = np.dot(weighted.T, coeff.astype(dtype))
+    dlnLdlabels = np.reshape(
+            _lvec_derivs_dot(G.astype(np.float64), linear_offsets)
+            / scales[None, :] - np.nan_to_num((labels - labels_0) / ldelta2),
+            (Nstars*nlabels, ))
+    
+    # the rest only needs sums over the stars, so the buffers are reused
+    sum_inv_var = np.sum(inv_var, axis=1, dtype=np.float64)
+    np.multiply(weighted, resids, out=resids)
+    chisq = np.sum(resids, dtype=np.float64)
+    np.multiply(weighted, weighted, out=weighted)
+    dlnLds = scatter * (np.sum(weighted, axis=1, dtype=np.float64) - sum_inv_var)
+    np.log(inv_var, out=inv_var)
+    lnL_pixels = -0.5 * chisq + 0.5 * (np.sum(inv_var, dtype=np.float64) - Npix * Nstars * np.log(2. * np.pi))
     
     lnLs = lnL_pixels + lnL_labels
-    
-    # derivatives of likelihood function with respect to s, theta, vec(l)
-    dlnLds = np.sum( scatter[:, None] * (inv_var**2 * resids**2 - inv_var ), axis = 1)       
-    dlnLdtheta = np.reshape( np.dot(inv_var * resids, np.nan_to_num(lvec)), (Npix * Nlabels,) )
-    xx = np.einsum(coeff, [0, 2], lvec_derivs, [1, 2, 3])    
-    dlnLdlabels = np.reshape(np.sum((resids * inv_var)[:, :, None] * xx , axis = 0) - np.nan_to_num((labels - labels_0) / ldelta2) , (Nstars*nlabels, ) )
-    dlnLdpars = np.hstack([dlnLdtheta, dlnLds, dlnLdlabels])  
-    
-    #print(np.isnan(dlnLdpars))
-    
-    print (lnL_labels, lnL_pixels, -2. * lnLs) 
+    dlnLdpars = np.hstack([dlnLdtheta.astype(np.float64), dlnLds, dlnLdlabels])  
     
     return -2. * lnLs, -2. * dlnLdpars
     
     
-def test_training_step_objective_function(pars, fluxes, ivars, lvec, lvec_derivs, ldelta, Nstars, Nlabels, Npix):
+def test_training_step_objective_function(pars, fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales):
     '''
     this tests the derivatives of the training_step_objective_function
     '''
-    q, dqdp = training_step_objective_function(pars, fluxes, ivars, lvec, lvec_derivs, ldelta, Nstars, Nlabels, Npix)
+    args = (fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales)
+    q, dqdp = training_step_objective_function(pars, *args)
     
     for k in range(len(pars)):
         pars1 = 1. * pars
-        tiny = 1e-7 * pars[k]
+        tiny = 1e-7 * max(abs(pars[k]), 1.)
         pars1[k] += tiny
-        q1, foo = training_step_objective_function(pars1, fluxes, ivars, lvec, lvec_derivs, ldelta, Nstars, Nlabels, Npix)
+        q1, foo = training_step_objective_function(pars1, *args)
         dqdpk = (q1-q)/tiny
         print (k, q, q1, dqdpk, dqdp[k], pars[k], (dqdp[k]-dqdpk)/(dqdp[k]+dqdpk) )
         
     return True
 
-def train_all_wavelength(fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, coeff_old, scatter_old, pivots, scales): 
+def train_all_wavelength(fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, coeff_old, scatter_old, pivots, scales, dtype=np.float64): 
     '''
     optimizes the scatter and the coeffcients at one wavelength 
+    
+    the objective is evaluated in dtype, e.g. np.float32 to halve its memory
     '''
     # OLD CODE!
 #    x0 = np.zeros((len(lvec_derivs[0])+1,))
@@ -107,9 +138,12 @@ def train_all_wavelength(fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix,
     x0 = pack(coeff_old, scatter_old, labels_0, Npix, Nlabels, Nstars, nlabels)
     
     # testing... 
-    # test_training_step_objective_function(x0, fluxes, ivars, lvec, lvec_derivs, ldelta_vec, Nstars, Nlabels, Npix)    
+    # test_training_step_objective_function(x0, fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales)    
     
-    res = op.minimize(training_step_objective_function, x0, args=(fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales), method='L-BFGS-B', 
+    fluxes = np.ascontiguousarray(fluxes, dtype=dtype)
+    ivars = np.ascontiguousarray(ivars, dtype=dtype)
+    buffers = {}
+    res = op.minimize(training_step_objective_function, x0, args=(fluxes, ivars, labels_0, ldelta, Nstars, Nlabels, Npix, nlabels, pivots, scales, buffers), method='L-BFGS-B', 
                       jac=True, options={'gtol':1e-12, 'ftol':1e-12}) # tolerances are magic numbers (determined by experiment)!  
                       
     print (res.success)
@@ -144,11 +178,147 @@ def get_pivots_and_scales(label_vals):
     
     return pivots, scales
    
-def _train_model_new(ds):
-    
+def _regress_pixel_blocks(fluxes, ivars, lvec, block_size=256, scatters=None,
+                          block_func=None):
+    """
+    Regresses all pixels, block by block, at fixed labels
+
+    Parameters
+    ----------
+    fluxes, ivars: numpy ndarray, shape (npix, nstars)
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+    block_size: int
+        number of pixels regressed together
+    scatters: numpy ndarray, shape (npix, ), optional
+        starting values of the scatters
+    block_func: function, optional
+        called as block_func(start, stop, chisqs) after each block, with
+        the chi squareds of its pixels, shape (stop-start, nstars)
+
+    Returns
+    -------
+    coeffs, scatters, precisions: numpy ndarray
+        as in _train_model
+    star_chisqs, pixel_chisqs: numpy ndarray
+        chi squareds summed over the pixels and over the stars
+    logdet_Cinv: float
+        log determinant of the inverse covariances of all pixels
+    """
+    npixels, nstars = fluxes.shape
+    lvec_prods, triu = _get_lvec_products(lvec)
+    coeffs = np.zeros((npixels, lvec.shape[1]))
+    new_scatters = np.zeros(npixels)
+    precisions = np.zeros(npixels)
+    star_chisqs = np.zeros(nstars)
+    pixel_chisqs = np.zeros(npixels)
+    logdet_Cinv = 0.
+    for start in range(0, npixels, block_size):
+        stop = min(start + block_size, npixels)
+        ln_scatters = None
+        if scatters is not None:
+            ln_scatters = np.log(scatters[start:stop])
+        blob = _do_regressions(
+                np.ascontiguousarray(fluxes[start:stop], dtype=np.float64),
+                np.ascontiguousarray(ivars[start:stop], dtype=np.float64),
+                lvec, lvec_prods, triu, ln_scatters=ln_scatters)
+        coeffs[start:stop] = blob[0]
+        new_scatters[start:stop] = blob[4]
+        precisions[start:stop] = blob[5]
+        block_chisqs = blob[2]**2
+        star_chisqs += block_chisqs.sum(axis=0)
+        pixel_chisqs[start:stop] = block_chisqs.sum(axis=1)
+        logdet_Cinv += np.sum(blob[3])
+        if block_func is not None:
+            block_func(start, stop, block_chisqs)
+    return coeffs, new_scatters, precisions, star_chisqs, pixel_chisqs, \
+            logdet_Cinv
+
+
+def _fit_label_blocks(coeffs, scatters, fluxes, ivars, labels, prior_mean,
+                      prior_ivar, block_size=256):
+    """
+    Fits the labels of all training stars, block by block, at fixed model
+
+    Parameters
+    ----------
+    coeffs, scatters: numpy ndarray
+        the model
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+    labels: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled starting labels
+    prior_mean, prior_ivar: numpy ndarray, shape (nstars, nlabels)
+        Gaussian prior on the pivoted and scaled labels
+    block_size: int
+        number of stars fitted together
+
+    Returns
+    -------
+    labels: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled best-fit labels
+    chisq: float
+        sum of the chi squareds of all stars, prior included
+    """
+    new_labels = np.zeros(labels.shape)
+    chisq = 0.
+    for start in range(0, len(labels), block_size):
+        stop = min(start + block_size, len(labels))
+        block_ivars = np.asarray(ivars[start:stop], dtype=np.float64)
+        weights = block_ivars / (1. + block_ivars * scatters[None, :]**2)
+        fit = _fit_labels(
+                coeffs, np.asarray(fluxes[start:stop], dtype=np.float64),
+                weights, labels[start:stop], prior_mean[start:stop],
+                prior_ivar[start:stop])
+        new_labels[start:stop] = fit[0]
+        chisq += np.sum(fit[2])
+    return new_labels, chisq
+
+
+def _train_model_new(ds, method='block', block_size=256, max_iter=50,
+                     tol=1e-4, dtype=np.float64):
+    """
+    Trains the model and the training labels, given errors on the labels
+
+    The labels are free parameters with a Gaussian prior from ds.tr_label
+    and ds.tr_delta. Given the labels the pixels decouple, and given the
+    model the stars decouple, so by default the two are solved for in
+    turn: all pixels are regressed at fixed labels (as in _train_model,
+    starting from the previous scatters), then the labels of all stars
+    are fitted at fixed model (as in _infer_labels, with the prior). Each
+    step lowers the same objective; the step of the labels is extrapolated
+    while that lowers it further. Labels without a finite, positive error
+    are held fixed.
+
+    Parameters
+    ----------
+    ds: Dataset
+    method: str
+        'block' for the alternating solver; 'lbfgs' optimizes all
+        parameters at once with scipy, which only works for small
+        training sets
+    block_size: int
+        number of pixels, or stars, solved together
+    max_iter: int
+        maximum number of alternations
+    tol: float
+        stop once no label moves by more than tol of its scale
+    dtype: numpy dtype
+        for method 'lbfgs', the precision of the objective evaluations
+
+    Returns
+    -------
+    coeffs, scatters: numpy ndarray
+        the model
+    new_labels: numpy ndarray, shape (nstars, nlabels)
+        best-fit training labels
+    pivots, scales: numpy ndarray
+        label pivots and scales
+    precisions: numpy ndarray, or None for method 'lbfgs'
+        precision of the log scatters
+    star_chisqs, pixel_chisqs: numpy ndarray
+        chi squareds summed over the pixels and over the stars
+    """
     label_vals = ds.tr_label
-    #lams = ds.wl
-    #npixels = len(lams)
     fluxes = ds.tr_flux
     ivars = ds.tr_ivar
     ldelta = ds.tr_delta
@@ -156,15 +326,81 @@ def _train_model_new(ds):
     
     # for training, ivar can't be zero, otherwise you get singular matrices
     # DWH says: make sure no ivar goes below 1 or 0.01
-    ivars[ivars<0.01] = 0.01
+    # (on a copy, so that the dataset and what is derived from it,
+    # e.g. the SNR, are left as they are)
+    ivars = np.where(ivars < 0.01, 0.01, ivars)
 
     pivots, scales = get_pivots_and_scales(label_vals) 
-    lvec, lvec_derivs = _get_lvec(label_vals, pivots, scales, derivs=True)
     scaled_ldelta = ldelta / scales[None, :]
-    
-    
-    # NEW CODE! 
-    
+
+    if method == 'lbfgs':
+        return _train_model_lbfgs(ds, fluxes, ivars, label_vals,
+                                  scaled_ldelta, pivots, scales, dtype)
+    if method != 'block':
+        raise ValueError("method must be 'block' or 'lbfgs', not %s" % method)
+
+    prior_mean = (label_vals - pivots[None, :]) / scales[None, :]
+    fixed = ~(np.isfinite(scaled_ldelta) & (scaled_ldelta > 0))
+    prior_ivar = np.ones(prior_mean.shape)
+    prior_ivar[~fixed] = 1. / scaled_ldelta[~fixed]**2
+    # a label that is held fixed is pinned by a very narrow prior
+    prior_ivar[fixed] = 1e16
+
+    def pixel_step(labels, scatters):
+        lvec = _get_lvec(labels, np.zeros(nlabels), np.ones(nlabels),
+                         derivs=False)
+        fit = _regress_pixel_blocks(fluxes.swapaxes(0, 1),
+                                    ivars.swapaxes(0, 1), lvec, block_size,
+                                    scatters)
+        prior = np.sum(prior_ivar * (labels - prior_mean)**2)
+        return fit, np.sum(fit[3]) - fit[5] + prior
+
+    labels = prior_mean.copy()
+    fit, objective = pixel_step(labels, ds.scatter_old)
+    accel = 2.
+    change = np.inf
+    for it in range(max_iter):
+        coeffs, scatters = fit[:2]
+        new_labels, star_objective = _fit_label_blocks(
+                coeffs, scatters, fluxes, ivars, labels, prior_mean,
+                prior_ivar, block_size)
+        star_objective -= fit[5]
+        change = np.max(np.abs(new_labels - labels))
+        # the alternation creeps along directions in which the labels and
+        # coefficients trade off; extrapolate along the step of the
+        # labels, and fall back to the plain step if that does not beat it
+        trial = labels + accel * (new_labels - labels)
+        trial_fit, trial_objective = pixel_step(trial, scatters)
+        if trial_objective < star_objective:
+            labels, fit, objective = trial, trial_fit, trial_objective
+            accel *= 1.5
+        else:
+            labels = new_labels
+            fit, objective = pixel_step(labels, scatters)
+            accel = max(accel / 2., 1.5)
+        print("Iteration %s: objective %s, largest label change %s"
+              % (it, objective, change))
+        if change < tol:
+            break
+    if change >= tol:
+        print("Labels did not converge in %s iterations" % max_iter)
+    coeffs, scatters, precisions, star_chisqs, pixel_chisqs = fit[:5]
+    new_labels = labels * scales[None, :] + pivots[None, :]
+    print("Done training model with errors on the labels. ")
+
+    return coeffs, scatters, new_labels, pivots, scales, precisions, \
+            star_chisqs, pixel_chisqs
+
+
+def _train_model_lbfgs(ds, fluxes, ivars, label_vals, scaled_ldelta, pivots,
+                       scales, dtype=np.float64):
+    """
+    Optimizes all coefficients, scatters and labels at once with L-BFGS-B
+
+    This is method 'lbfgs' of _train_model_new.
+    """
+    nlabels = label_vals.shape[1]
+    lvec = _get_lvec(label_vals, pivots, scales, derivs=False)
     fluxes = fluxes.swapaxes(0, 1)  # for consistency with lvec
     ivars = ivars.swapaxes(0, 1)
     
@@ -173,40 +409,18 @@ def _train_model_new(ds):
     Nstars = len(fluxes[0])
     Nlabels = len(lvec[1])
 
-    # NOT NEEDED ANYMORE    
-#    # this gives delta_nk; same as lvec, but for uncertainties on lables
-#    linear_offsets = scaled_ldelta
-#    quadratic_offsets = np.array([np.outer(m, m)[np.triu_indices(label_vals.shape[1])]for m in (linear_offsets)]) * 10
-#    ones = np.ones((Nstars, 1)) * 0.001
-#    ldelta_vec = np.hstack((ones, linear_offsets, quadratic_offsets))
-
-
-    # OLD CODE!
-#    coeffs = []
-#    scatters = []
-#    chisqs = []
-#    for m in range(1000, 1001): #npixels):
-#        print('Working on pixel {}'.format(m))
-#        res, chis_m = train_one_wavelength(fluxes[m], ivars[m], lvec, lvec_derivs, scaled_ldelta)
-#        coeffs_m = res.x[:-1]
-#        scatter_m = res.x[-1]
-#        coeffs.append(coeffs_m)
-#        scatters.append(scatter_m)
-#        chisqs.append(chis_m)
-        
-    
-    res, chisqs = train_all_wavelength(fluxes, ivars, label_vals, scaled_ldelta, Nstars, Nlabels, Npix, nlabels, ds.coeff_old, ds.scatter_old, pivots, scales)
+    res, chisqs = train_all_wavelength(fluxes, ivars, label_vals, scaled_ldelta, Nstars, Nlabels, Npix, nlabels, ds.coeff_old, ds.scatter_old, pivots, scales, dtype)
     
     coeffs, scatters, new_labels = unpack(res.x, Npix, Nlabels, Nstars, nlabels)
-#    coeffs = np.reshape(res.x[:Npix*Nlabels], (Npix, Nlabels))
-#    scatters = res.x[Npix*Nlabels:Npix*(Nlabels+1)]
-#    new_labels = np.reshape(res.x[Npix*(Nlabels+1):], (Nstars, Nlabels))
     
     # Calc chi squares
-    chisqs = np.array(chisqs)
+    lvec = _get_lvec(new_labels, pivots, scales, derivs=False)
+    Cinv = ivars / (1. + ivars * scatters[:, None]**2)
+    chisqs = Cinv * (fluxes - np.dot(coeffs, lvec.T))**2
     print("Done training model with errors on the labels. ")
 
-    return np.array(coeffs), np.array(scatters), np.array(new_labels), chisqs, pivots, scales
+    return coeffs, scatters, new_labels, pivots, scales, None, \
+            np.sum(chisqs, axis=0), np.sum(chisqs, axis=1)
 
 def _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec, scatter):
     """
@@ -256,6 +470,7 @@ def _do_one_regression(lams, fluxes, ivars, lvec):
     Optimizes to find the scatter associated with the best-fit model.
     This scatter is the deviation between the observed spectrum and the model.
     It is wavelength-independent, so we perform this at a single wavelength.
+    The optimization itself is done by _do_regressions.
     Input
     -----
     lams: numpy ndarray
@@ -270,131 +485,508 @@ def _do_one_regression(lams, fluxes, ivars, lvec):
     -----
     output of do_one_regression_at_fixed_scatter
     """
-    ln_scatter_vals = np.arange(np.log(0.0001), 0., 0.5)
-    # minimize over the range of scatter possibilities
-    chis_eval = np.zeros_like(ln_scatter_vals)
-    for jj, ln_scatter_val in enumerate(ln_scatter_vals):
-        coeff, lTCinvl, chi, logdet_Cinv = \
-            _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec,
-                                               np.exp(ln_scatter_val))
-        chis_eval[jj] = np.sum(chi*chi) - logdet_Cinv
-    if np.any(np.isnan(chis_eval)):
-        best_scatter = np.exp(ln_scatter_vals[-1])
-        _r = _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec,
-                                                best_scatter)
-        return _r + (best_scatter, )
-    lowest = np.argmin(chis_eval)
-    if (lowest == 0) or (lowest == len(ln_scatter_vals) - 1):
-        best_scatter = np.exp(ln_scatter_vals[lowest])
-        _r = _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec,
-                                                best_scatter)
-        return _r + (best_scatter, )
-    ln_scatter_vals_short = ln_scatter_vals[np.array(
-        [lowest-1, lowest, lowest+1])]
-    chis_eval_short = chis_eval[np.array([lowest-1, lowest, lowest+1])]
-    z = np.polyfit(ln_scatter_vals_short, chis_eval_short, 2)
-    fit_pder = np.polyder(z)
-    best_scatter = np.exp(np.roots(fit_pder)[0])
-    _r = _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec,
-                                            best_scatter)
-    return _r + (best_scatter, )
-
-
-def _get_lvec(label_vals, pivots, scales, derivs):
-    """
-    Constructs a label vector for an arbitrary number of labels
-    Assumes that our model is quadratic in the labels
-    
-    Comment: this is really slow, but we will only have to compute it once!
+    lvec_prods, triu = _get_lvec_products(lvec)
+    blob = _do_regressions(fluxes[None, :], ivars[None, :], lvec,
+                           lvec_prods, triu)
+    return tuple(b[0] for b in blob[:5])
+
+
+def _lvec_derivs_dot(coeffs, linear_offsets):
+    """
+    Contracts coefficients with the label vector derivatives
+
+    Same as summing coeffs * lvec_derivs over the label vector terms,
+    without building lvec_derivs: for the quadratic model this is the
+    gradient of coeffs . lvec wrt the scaled labels.
 
     Parameters
     ----------
-    label_vals: numpy ndarray, shape (nstars, nlabels)
-        labels 
-    pivots: numpy ndarray, shape (nlabels, )
-        offset we subtract from the label_vals
-    scales: numpy ndarray, shape (nlabels, )
-        scale we divide out of the label_vals
-    derivs: return also the derivatives of the vector wrt the labels
+    coeffs: numpy ndarray, shape (..., nterms)
+        coefficients on each element of the label vector
+    linear_offsets: numpy ndarray, shape (..., nlabels)
+        scaled label offsets, the structured output of _get_lvec;
+        broadcast against coeffs, e.g. (nstars, 1, nlabels) against
+        (npix, nterms) gives the (nstars, npix, nlabels) model Jacobian
 
     Returns
     -------
-    lvec: numpy ndarray
-        label vector
-    dlvec_dl: numpy ndarray (if derivs)
-        label vector derivatives
-        
-    Notes
-    --------
-    lvec_derivs and lvec is now in units of the scaled labels! 
+    numpy ndarray, shape (..., nlabels)
     """
-    if len(label_vals.shape) == 1:
-        label_vals = np.array([label_vals])
-    nlabels = label_vals.shape[1]
-    nstars = label_vals.shape[0]
-    # specialized to second-order model
-    linear_offsets = (label_vals - pivots[None, :]) / scales[None, :]
-    quadratic_offsets = np.array([np.outer(m, m)[np.triu_indices(nlabels)]
-                                  for m in (linear_offsets)])
-    ones = np.ones((nstars, 1))
-    lvec = np.hstack((ones, linear_offsets, quadratic_offsets))
-    if not derivs:
-        return lvec
-    ones_derivs = np.zeros((nstars, 1, nlabels))
-    linear_derivs = np.zeros((nstars, nlabels, nlabels))
-    for i in range(nstars):
-        linear_derivs[i] = np.eye(nlabels) 
-    quadratic_derivs = np.zeros((nstars, len(quadratic_offsets[1]), nlabels))
-    for n in range(nstars):
-        for k in range(nlabels): 
-            foo = np.zeros((nlabels, nlabels))
-            foo[k, :] = linear_offsets[n]
-            foo[:, k] = linear_offsets[n]
-            quadratic_derivs[n, :, k] = np.array(foo[np.triu_indices(nlabels)]) 
-    lvec_derivs = np.hstack((ones_derivs, linear_derivs, quadratic_derivs))
-    
-    return lvec, lvec_derivs
+    nlabels = linear_offsets.shape[-1]
+    lin, quad = _get_quadratic_coeff_matrix(coeffs, nlabels)
+    return lin + np.matmul(quad, linear_offsets[..., None])[..., 0]
+
 
-def _train_model(ds):
+def _get_lvec_products(lvec):
+    """
+    Pairwise products of the label vector components, for all stars
+
+    Only the upper triangle of the outer product l l^T is kept, since the
+    normal matrix of the regression is symmetric.
+
+    Parameters
+    ----------
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+
+    Returns
+    -------
+    lvec_prods: numpy ndarray, shape (nstars, nterms*(nterms+1)/2)
+        upper-triangular products of the label vector components
+    triu: tuple of numpy ndarrays
+        row and column indices of the products in the (nterms, nterms) matrix
+    """
+    triu = np.triu_indices(lvec.shape[1])
+    lvec_prods = lvec[:, triu[0]] * lvec[:, triu[1]]
+    return lvec_prods, triu
+
+
+def _forward_substitution(chol, b):
+    """
+    Solves chol y = b for a batch of lower triangular matrices chol
+
+    Parameters
+    ----------
+    chol: numpy ndarray, shape (npix, nterms, nterms)
+    b: numpy ndarray, shape (npix, nterms)
+
+    Returns
+    -------
+    y: numpy ndarray, shape (npix, nterms)
+    """
+    y = np.zeros(b.shape)
+    for i in range(b.shape[1]):
+        y[:, i] = (b[:, i] - np.sum(chol[:, i, :i] * y[:, :i], axis=1)) \
+                / chol[:, i, i]
+    return y
+
+
+def _cho_solve(chol, b):
+    """
+    Solves A x = b for a batch of A = chol chol^T
+
+    Parameters
+    ----------
+    chol: numpy ndarray, shape (npix, nterms, nterms)
+        lower Cholesky factors, e.g. from np.linalg.cholesky
+    b: numpy ndarray, shape (npix, nterms)
+
+    Returns
+    -------
+    x: numpy ndarray, shape (npix, nterms)
+    """
+    y = _forward_substitution(chol, b)
+    x = np.zeros(b.shape)
+    for i in reversed(range(b.shape[1])):
+        x[:, i] = (y[:, i] - np.sum(chol[:, i+1:, i] * x[:, i+1:], axis=1)) \
+                / chol[:, i, i]
+    return x
+
+
+def _solve_normal_equations(lTCinvl_triu, lTCinvf, triu):
+    """
+    Solves the normal equations of a block of pixels in one batched call
+
+    The normal matrices are factored once, and the factors are returned
+    for further solves with the same matrices.
+
+    Parameters
+    ----------
+    lTCinvl_triu: numpy ndarray, shape (npix, nterms*(nterms+1)/2)
+        upper triangles of the normal matrices
+    lTCinvf: numpy ndarray, shape (npix, nterms)
+        right-hand sides
+    triu: indices of the upper triangle, see _get_lvec_products
+
+    Returns
+    -------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        coefficients of the fit
+    lTCinvl: numpy ndarray, shape (npix, nterms, nterms)
+        the normal matrices
+    chol: numpy ndarray, shape (npix, nterms, nterms)
+        their lower Cholesky factors, see _cho_solve
+    """
+    npix, nterms = lTCinvf.shape
+    lTCinvl = np.zeros((npix, nterms, nterms))
+    lTCinvl[:, triu[0], triu[1]] = lTCinvl_triu
+    lTCinvl[:, triu[1], triu[0]] = lTCinvl_triu
+    try:
+        chol = np.linalg.cholesky(lTCinvl)
+    except np.linalg.LinAlgError:
+        print("np.linalg.LinAlgError, solve_normal_equations")
+        raise
+    coeffs = _cho_solve(chol, lTCinvf)
+    return coeffs, lTCinvl, chol
+
+
+def _do_regressions_at_fixed_scatter(fluxes, ivars, lvec, lvec_prods, triu,
+                                     scatters):
+    """
+    Same as _do_one_regression_at_fixed_scatter, for a block of pixels at once
+
+    The normal equations of all pixels are built with two matrix products
+    and solved in a single batched call.
+
+    Parameters
+    ----------
+    fluxes: numpy ndarray, shape (npix, nstars)
+        flux values for all stars at each pixel
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variance values for all stars at each pixel
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+    lvec_prods, triu: output of _get_lvec_products(lvec)
+    scatters: numpy ndarray, shape (npix, )
+        fixed scatter value for each pixel
+
+    Returns
+    -------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        coefficients of the fit
+    lTCinvl: numpy ndarray, shape (npix, nterms, nterms)
+        inverse covariance matrices for fit coefficients
+    chis: numpy ndarray, shape (npix, nstars)
+        chi at best fit
+    logdet_Cinv: numpy ndarray, shape (npix, )
+        log determinant of the inverse covariance matrices
+    chol: numpy ndarray, shape (npix, nterms, nterms)
+        lower Cholesky factors of lTCinvl
+    """
+    Cinv = ivars / (1 + ivars * scatters[:, None]**2)
+    lTCinvl_triu = np.dot(Cinv, lvec_prods)
+    lTCinvf = np.dot(Cinv * fluxes, lvec)
+    coeffs, lTCinvl, chol = _solve_normal_equations(
+            lTCinvl_triu, lTCinvf, triu)
+    if not np.all(np.isfinite(coeffs)):
+        raise RuntimeError('something is wrong with the coefficients')
+    chis = np.sqrt(Cinv) * (fluxes - np.dot(coeffs, lvec.T))
+    logdet_Cinv = np.sum(np.log(Cinv), axis=1)
+    return (coeffs, lTCinvl, chis, logdet_Cinv, chol)
+
+
+def _scatter_objective(fluxes, ivars, lvec, lvec_prods, triu, ln_scatters):
+    """
+    Profile objective of the scatter, and its derivatives, for a block of pixels
+
+    At fixed scatter the coefficients are solved for exactly, so the objective
+    sum(chi^2) - log det(Cinv) only depends on ln(scatter). Its second
+    derivative accounts for the change of the best-fit coefficients with the
+    scatter, using the same factorization of the normal matrix.
+
+    Parameters
+    ----------
+    fluxes, ivars: numpy ndarray, shape (npix, nstars)
+    lvec: numpy ndarray, shape (nstars, nterms)
+    lvec_prods, triu: output of _get_lvec_products(lvec)
+    ln_scatters: numpy ndarray, shape (npix, )
+
+    Returns
+    -------
+    coeffs, lTCinvl, chis, logdet_Cinv: as in
+        _do_regressions_at_fixed_scatter
+    obj, dobj, d2obj: numpy ndarrays, shape (npix, )
+        objective and its first and second derivatives wrt ln(scatter)
+    """
+    scatters = np.exp(ln_scatters)
+    coeffs, lTCinvl, chis, logdet_Cinv, chol = \
+            _do_regressions_at_fixed_scatter(
+                fluxes, ivars, lvec, lvec_prods, triu, scatters)
+    u = scatters[:, None]**2
+    Cinv = ivars / (1 + ivars * u)
+    resids = chis / np.sqrt(Cinv)
+    Cinv_resids = Cinv * resids
+    Cinv_resids2 = Cinv_resids * resids
+    Cinv2_resids2 = Cinv * Cinv_resids2
+    obj = np.sum(Cinv_resids2, axis=1) - logdet_Cinv
+    dobj = 2. * u[:, 0] * np.sum(Cinv - Cinv2_resids2, axis=1)
+    d2obj_fixed = np.sum(
+            4. * u * (Cinv - Cinv2_resids2)
+            + 4. * u * u * Cinv * (2. * Cinv2_resids2 - Cinv), axis=1)
+    cross = 4. * u * np.dot(Cinv * Cinv_resids, lvec)
+    # cross^T lTCinvl^-1 cross, with the factors of the coefficient solve
+    d2obj = d2obj_fixed - 0.5 * np.sum(
+            _forward_substitution(chol, cross)**2, axis=1)
+    return coeffs, lTCinvl, chis, logdet_Cinv, obj, dobj, d2obj
+
+
+def _do_regressions(fluxes, ivars, lvec, lvec_prods, triu, ln_scatters=None,
+                    tol=1e-4, max_iter=30):
+    """
+    Same as _do_one_regression, for a block of pixels at once
+
+    ln(scatter) is optimized for all pixels together with damped Newton
+    steps on the profile objective. A step that does not lower the
+    objective is halved; a pixel drops out once its step falls below tol.
+
+    Parameters
+    ----------
+    fluxes: numpy ndarray, shape (npix, nstars)
+        flux values for all stars at each pixel
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variance values for all stars at each pixel
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+    lvec_prods, triu: output of _get_lvec_products(lvec)
+    ln_scatters: numpy ndarray, shape (npix, ), optional
+        starting values of ln(scatter); by default they are estimated
+        from the residuals of a fit with negligible scatter
+    tol: float
+        required precision on ln(scatter)
+    max_iter: int
+        maximum number of objective evaluations per pixel
+
+    Returns
+    -------
+    the first four outputs of _do_regressions_at_fixed_scatter, plus the
+    best-fit scatters
+    and the precision achieved on ln(scatter)
+    """
+    npix, nstars = fluxes.shape
+    nterms = lvec.shape[1]
+    ln_lo, ln_hi = np.log(0.0001), 0.
+    max_step = 1.
+    guess = ln_scatters is None
+    if guess:
+        ln_scatters = ln_lo * np.ones(npix)
+    ln_scatters = np.clip(ln_scatters, ln_lo, ln_hi)
+
+    coeffs = np.zeros((npix, nterms))
+    lTCinvl = np.zeros((npix, nterms, nterms))
+    chis = np.zeros((npix, nstars))
+    logdet_Cinv = np.zeros(npix)
+    best_ln_scatters = ln_scatters.copy()
+    best_obj = np.inf * np.ones(npix)
+    steps = np.zeros(npix)
+    precisions = np.inf * np.ones(npix)
+    active = np.ones(npix, dtype=bool)
+    for it in range(max_iter):
+        pix = np.where(active)[0]
+        if len(pix) == 0:
+            break
+        out = _scatter_objective(
+                fluxes[pix], ivars[pix], lvec, lvec_prods, triu,
+                ln_scatters[pix])
+        obj, dobj, d2obj = out[4:]
+        better = obj <= best_obj[pix]
+        # accepted points: store the fit and propose a Newton step
+        acc = pix[better]
+        coeffs[acc] = out[0][better]
+        lTCinvl[acc] = out[1][better]
+        chis[acc] = out[2][better]
+        logdet_Cinv[acc] = out[3][better]
+        best_obj[acc] = obj[better]
+        best_ln_scatters[acc] = ln_scatters[acc]
+        dobj, d2obj = dobj[better], d2obj[better]
+        newton = -np.sign(dobj) * max_step
+        convex = d2obj > 0
+        newton[convex] = -dobj[convex] / d2obj[convex]
+        newton = np.clip(newton, -max_step, max_step)
+        if it == 0 and guess:
+            # jump to the excess variance of the residuals
+            resids2 = out[2][better]**2 / ivars[acc]
+            excess = np.sum(ivars[acc]**2 * (resids2 - 1. / ivars[acc]),
+                            axis=1) / np.sum(ivars[acc]**2, axis=1)
+            excess = np.maximum(excess, np.exp(2. * ln_lo))
+            newton = 0.5 * np.log(excess) - ln_scatters[acc]
+        new = np.clip(ln_scatters[acc] + newton, ln_lo, ln_hi)
+        steps[acc] = new - ln_scatters[acc]
+        # rejected points: backtrack towards the last accepted point
+        rej = pix[~better]
+        steps[rej] *= 0.5
+        ln_scatters[pix] = best_ln_scatters[pix] + steps[pix]
+        precisions[pix] = np.abs(steps[pix])
+        active[pix] = precisions[pix] >= tol
+    # pixels whose objective is undefined get the largest scatter
+    bad = np.isinf(best_obj)
+    if np.any(bad):
+        best_ln_scatters[bad] = ln_hi
+        precisions[bad] = np.nan
+        out = _scatter_objective(
+                fluxes[bad], ivars[bad], lvec, lvec_prods, triu,
+                best_ln_scatters[bad])
+        coeffs[bad], lTCinvl[bad], chis[bad], logdet_Cinv[bad] = out[:4]
+    return (coeffs, lTCinvl, chis, logdet_Cinv, np.exp(best_ln_scatters),
+            precisions)
+
+
+def _train_model(ds, block_size=256, chisqs_file=None, outlier_chisq=None):
     """
     This determines the coefficients of the model using the training data
+
+    All pixels in a block are regressed together, so that there is no
+    Python loop over pixels and the design matrix is never replicated.
+    The chi squareds are summed per star and per pixel as the blocks are
+    done; the full (npixels, nstars) matrix is only kept if chisqs_file
+    is given.
+
     Parameters
     ----------
     ds: Dataset
+    block_size: int
+        number of pixels regressed together; bounds the memory used
+    chisqs_file: str, optional
+        .npy file to write the full matrix of chi squareds to, as a memmap
+    outlier_chisq: float, optional
+        list every (pixel, star) with a chi squared above this
+
     Returns
     -------
-    model: model
-        best-fit Cannon model
+    coeffs, scatters: numpy ndarray
+        the model
+    chisqs: numpy ndarray of shape (npixels, nstars), or None
+        chi squareds, memory-mapped from chisqs_file
+    pivots, scales: numpy ndarray
+        label pivots and scales
+    precisions: numpy ndarray
+        precision of the log scatters
+    star_chisqs: numpy ndarray of length nstars
+        chi squared of each training star, summed over the pixels
+    pixel_chisqs: numpy ndarray of length npixels
+        chi squared of each pixel, summed over the training stars
+    outliers: numpy record array, or None
+        with fields pixel, star and chisq
     """
-    label_names = ds.get_plotting_labels()
     label_vals = ds.tr_label
     lams = ds.wl
     npixels = len(lams)
     fluxes = ds.tr_flux
     ivars = ds.tr_ivar
+    nstars = fluxes.shape[0]
     
     # for training, ivar can't be zero, otherwise you get singular matrices
     # DWH says: make sure no ivar goes below 1 or 0.01
-    ivars[ivars<0.01] = 0.01
+    # (on a copy, so that the dataset and what is derived from it,
+    # e.g. the SNR, are left as they are)
+    ivars = np.where(ivars < 0.01, 0.01, ivars)
 
     pivots, scales = get_pivots_and_scales(label_vals)
     lvec = _get_lvec(label_vals, pivots, scales, derivs=False)
-    lvec_full = np.array([lvec,] * npixels)
+
+    chisqs = None
+    if chisqs_file is not None:
+        chisqs = np.lib.format.open_memmap(
+                chisqs_file, mode='w+', dtype=np.float64,
+                shape=(npixels, nstars))
+    outliers = []
+    def keep_chisqs(start, stop, block_chisqs):
+        if chisqs is not None:
+            chisqs[start:stop] = block_chisqs
+        if outlier_chisq is not None:
+            pix, star = np.nonzero(block_chisqs > outlier_chisq)
+            outliers.append((pix + start, star, block_chisqs[pix, star]))
 
     # Perform REGRESSIONS
-    fluxes = fluxes.swapaxes(0,1)  # for consistency with lvec_full
-    ivars = ivars.swapaxes(0,1)
-    
-    # one per pix
-    blob = list(map(
-        _do_one_regression, lams, fluxes, ivars, lvec_full))
-    coeffs = np.array([b[0] for b in blob])
-    covs = np.array([np.linalg.inv(b[1]) for b in blob])
-    chis = np.array([b[2] for b in blob])
-    scatters = np.array([b[4] for b in blob])
-
-    # Calc chi sq
-    all_chisqs = chis*chis
+    # (fluxes transposed for consistency with lvec)
+    coeffs, scatters, precisions, star_chisqs, pixel_chisqs, _ = \
+            _regress_pixel_blocks(
+                fluxes.swapaxes(0,1), ivars.swapaxes(0,1), lvec,
+                block_size=block_size, block_func=keep_chisqs)
+    if outlier_chisq is not None:
+        pix, star, chisq = [np.concatenate(a) for a in zip(*outliers)] \
+                if outliers else [np.zeros(0)] * 3
+        outliers = np.rec.fromarrays(
+                [pix.astype(int), star.astype(int), chisq],
+                names=['pixel', 'star', 'chisq'])
+    else:
+        outliers = None
+    if chisqs is not None:
+        chisqs.flush()
     print("Done training model. ")
 
-    return coeffs, scatters, all_chisqs, pivots, scales
+    return coeffs, scatters, chisqs, pivots, scales, precisions, \
+            star_chisqs, pixel_chisqs, outliers
+
+
+def _get_normal_sums(fluxes, ivars, lvec, scatters, block_size=256):
+    """
+    Sums over a set of stars of the normal equations of every pixel
+
+    At fixed scatter the regression of each pixel is linear least squares,
+    so these sums are sufficient statistics: the sums of two sets of stars
+    are the sums of their union, and stars can be taken out again by
+    subtracting their sums.
+
+    Parameters
+    ----------
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+        as in the dataset; ivars are raised to 0.01 as in _train_model
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+    scatters: numpy ndarray, shape (npix, )
+    block_size: int
+        number of pixels done together
+
+    Returns
+    -------
+    lTCinvl_triu: numpy ndarray, shape (npix, nterms*(nterms+1)/2)
+        upper triangles of the normal matrices, see _get_lvec_products
+    lTCinvf: numpy ndarray, shape (npix, nterms)
+        right-hand sides of the normal equations
+    fTCinvf: numpy ndarray, shape (npix, )
+        weighted sums of the squared fluxes
+    """
+    npixels = fluxes.shape[1]
+    lvec_prods, triu = _get_lvec_products(lvec)
+    lTCinvl_triu = np.zeros((npixels, lvec_prods.shape[1]))
+    lTCinvf = np.zeros((npixels, lvec.shape[1]))
+    fTCinvf = np.zeros(npixels)
+    for start in range(0, npixels, block_size):
+        stop = min(start + block_size, npixels)
+        block_fluxes = np.asarray(fluxes[:, start:stop], dtype=np.float64).T
+        block_ivars = np.asarray(ivars[:, start:stop], dtype=np.float64).T
+        block_ivars = np.where(block_ivars < 0.01, 0.01, block_ivars)
+        Cinv = block_ivars / (1 + block_ivars * scatters[start:stop, None]**2)
+        lTCinvl_triu[start:stop] = np.dot(Cinv, lvec_prods)
+        lTCinvf[start:stop] = np.dot(Cinv * block_fluxes, lvec)
+        fTCinvf[start:stop] = np.sum(Cinv * block_fluxes**2, axis=1)
+    return lTCinvl_triu, lTCinvf, fTCinvf
+
+
+def _solve_normal_sums(lTCinvl_triu, lTCinvf, fTCinvf):
+    """
+    Coefficients and chi squareds of every pixel from _get_normal_sums
+
+    Returns
+    -------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        coefficients of the fit
+    pixel_chisqs: numpy ndarray, shape (npix, )
+        chi squared of each pixel, summed over the stars
+    """
+    triu = np.triu_indices(lTCinvf.shape[1])
+    coeffs = _solve_normal_equations(lTCinvl_triu, lTCinvf, triu)[0]
+    pixel_chisqs = fTCinvf - np.sum(coeffs * lTCinvf, axis=1)
+    return coeffs, pixel_chisqs
+
+
+def _get_star_chisqs(fluxes, ivars, lvec, coeffs, scatters, block_size=256):
+    """
+    Chi squared of each star, summed over the pixels, for a given model
+
+    Parameters
+    ----------
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+        as in the dataset; ivars are raised to 0.01 as in _train_model
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+    coeffs, scatters: numpy ndarray
+        the model
+    block_size: int
+        number of pixels done together
+
+    Returns
+    -------
+    star_chisqs: numpy ndarray, shape (nstars, )
+    """
+    nstars, npixels = fluxes.shape
+    star_chisqs = np.zeros(nstars)
+    for start in range(0, npixels, block_size):
+        stop = min(start + block_size, npixels)
+        block_fluxes = np.asarray(fluxes[:, start:stop], dtype=np.float64)
+        block_ivars = np.asarray(ivars[:, start:stop], dtype=np.float64)
+        block_ivars = np.where(block_ivars < 0.01, 0.01, block_ivars)
+        Cinv = block_ivars / (1 + block_ivars * scatters[start:stop]**2)
+        resids = block_fluxes - np.dot(lvec, coeffs[start:stop].T)
+        star_chisqs += np.sum(Cinv * resids**2, axis=1)
+    return star_chisqs
@@ -187,7 +187,8 @@ def train():
 
     np.savez("%s/coeffs.npz" %DATA_DIR, md.coeffs)
     np.savez("%s/scatters.npz" %DATA_DIR, md.scatters)
-    np.savez("%s/chisqs.npz" %DATA_DIR, md.chisqs)
+    np.savez("%s/star_chisqs.npz" %DATA_DIR, md.star_chisqs)
+    np.savez("%s/pixel_chisqs.npz" %DATA_DIR, md.pixel_chisqs)
     np.savez("%s/pivots.npz" %DATA_DIR, md.pivots)
 
 
@@ -203,7 +204,8 @@ def validate():
 
     coeffs = np.load("%s/coeffs.npz" %DATA_DIR)['arr_0']
     scatters = np.load("%s/scatters.npz" %DATA_DIR)['arr_0']
-    chisqs = np.load("%s/chisqs.npz" %DATA_DIR)['arr_0']
+    star_chisqs = np.load("%s/star_chisqs.npz" %DATA_DIR)['arr_0']
+    pixel_chisqs = np.load("%s/pixel_chisqs.npz" %DATA_DIR)['arr_0']
     pivots = np.load("%s/pivots.npz" %DATA_DIR)['arr_0']
 
     ds = dataset.Dataset(
@@ -216,7 +218,8 @@ def validate():
     md = model.CannonModel(2)
     md.coeffs = coeffs
     md.scatters = scatters
-    md.chisqs = chisqs
+    md.star_chisqs = star_chisqs
+    md.pixel_chisqs = pixel_chisqs
     md.pivots = pivots
     md.diagnostics_leading_coeffs(ds)
 
@@ -266,7 +269,8 @@ def test():
 
     coeffs = np.load("%s/coeffs.npz" %DATA_DIR)['arr_0']
     scatters = np.load("%s/scatters.npz" %DATA_DIR)['arr_0']
-    chisqs = np.load("%s/chisqs.npz" %DATA_DIR)['arr_0']
+    star_chisqs = np.load("%s/star_chisqs.npz" %DATA_DIR)['arr_0']
+    pixel_chisqs = np.load("%s/pixel_chisqs.npz" %DATA_DIR)['arr_0']
     pivots = np.load("%s/pivots.npz" %DATA_DIR)['arr_0']
 
     ds = dataset.Dataset(
@@ -279,7 +283,8 @@ def test():
     md = model.CannonModel(2)
     md.coeffs = coeffs
     md.scatters = scatters
-    md.chisqs = chisqs
+    md.star_chisqs = star_chisqs
+    md.pixel_chisqs = pixel_chisqs
     md.pivots = pivots
     md.diagnostics_leading_coeffs(ds)
 
@@ -57,8 +57,8 @@ def test_step(date):
     lamost_label = np.load("%s/output/%s_tr_label.npz" %(SPEC_DIR,date))['arr_0']
     apogee_label = np.load("./ref_label.npz")['arr_0']
 
-    ds = dataset.Dataset(wl, test_ID, test_flux[0:2,:], test_ivar[0:2,:], 
-            lamost_label, test_ID, test_flux, test_ivar)
+    ds = dataset.inference_dataset(wl, test_ID, test_flux, test_ivar)
+    ds.tr_label = lamost_label
 
     #np.savez(COL_DIR + "/%s_test_flux.npz" %date, ds.test_flux)
     #np.savez(COL_DIR + "/%s_test_ivar.npz" %date, ds.test_ivar)
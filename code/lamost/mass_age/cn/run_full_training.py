@@ -109,7 +109,8 @@ def train():
     m.fit(ds)
     np.savez("./coeffs.npz", m.coeffs)
     np.savez("./scatters.npz", m.scatters)
-    np.savez("./chisqs.npz", m.chisqs)
+    np.savez("./star_chisqs.npz", m.star_chisqs)
+    np.savez("./pixel_chisqs.npz", m.pixel_chisqs)
     np.savez("./pivots.npz", m.pivots)
     m.diagnostics_leading_coeffs(ds)
     #m.diagnostics_leading_coeffs_triangle(ds)
@@ -144,7 +145,8 @@ def test_step():
     m = model.CannonModel(2)
     m.coeffs = np.load("./culled_coeffs.npz")['arr_0']
     m.scatters = np.load("./culled_scatters.npz")['arr_0']
-    m.chisqs = np.load("./culled_chisqs.npz")['arr_0']
+    m.star_chisqs = np.load("./culled_star_chisqs.npz")['arr_0']
+    m.pixel_chisqs = np.load("./culled_pixel_chisqs.npz")['arr_0']
     m.pivots = np.load("./culled_pivots.npz")['arr_0']
 
     nguesses = 10
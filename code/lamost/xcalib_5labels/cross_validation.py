@@ -40,7 +40,8 @@ def train(ds, ii):
     m.fit(ds)
     np.savez("./ex%s_coeffs.npz" %ii, m.coeffs)
     np.savez("./ex%s_scatters.npz" %ii, m.scatters)
-    np.savez("./ex%s_chisqs.npz" %ii, m.chisqs)
+    np.savez("./ex%s_star_chisqs.npz" %ii, m.star_chisqs)
+    np.savez("./ex%s_pixel_chisqs.npz" %ii, m.pixel_chisqs)
     np.savez("./ex%s_pivots.npz" %ii, m.pivots)
     fig = m.diagnostics_leading_coeffs(ds)
     plt.savefig("ex%s_leading_coeffs.png" %ii)
@@ -54,7 +55,8 @@ def load_model(ii):
     m = model.CannonModel(2)
     m.coeffs = np.load("./ex%s_coeffs.npz" %ii)['arr_0']
     m.scatters = np.load("./ex%s_scatters.npz" %ii)['arr_0']
-    m.chisqs = np.load("./ex%s_chisqs.npz" %ii)['arr_0']
+    m.star_chisqs = np.load("./ex%s_star_chisqs.npz" %ii)['arr_0']
+    m.pixel_chisqs = np.load("./ex%s_pixel_chisqs.npz" %ii)['arr_0']
     m.pivots = np.load("./ex%s_pivots.npz" %ii)['arr_0']
     return m
 
@@ -74,27 +76,14 @@ def test(ds, m, group):
     print("m pivots shape")
     print(m.pivots.shape)
     starting_guesses = tr_label[choose]-m.pivots
-    labels = np.zeros((nguesses, nobj, nlabels))
-    chisq = np.zeros((nguesses, nobj))
-    errs = np.zeros(labels.shape)
-
-    for ii,guess in enumerate(starting_guesses):
-        a,b,c = test_step_iteration(ds,m,starting_guesses[ii])
-        labels[ii,:] = a
-        chisq[ii,:] = b
-        errs[ii,:] = c
+    best_errs, best_chisq, labels, errs, chisq, pruned = m.infer_labels(
+            ds, starting_guesses, return_candidates=True)
+    best_labels = ds.test_label_vals
 
     np.savez("ex%s_labels_all_starting_vals.npz" %group, labels)
     np.savez("ex%s_chisq_all_starting_vals.npz" %group, chisq)
     np.savez("ex%s_errs_all_starting_vals.npz" %group, errs)
-
-    choose = np.argmin(chisq, axis=0)
-    best_chisq = np.min(chisq, axis=0)
-    best_labels = np.zeros(tr_label.shape)
-    best_errs = np.zeros(best_labels.shape)
-    for jj,val in enumerate(choose):
-        best_labels[jj,:] = labels[:,jj,:][val]
-        best_errs[jj,:] = errs[:,jj,:][val]
+    np.savez("ex%s_pruned_all_starting_vals.npz" %group, pruned)
 
     np.savez("./ex%s_cannon_label_vals.npz" %group, best_labels)
     np.savez("./ex%s_cannon_label_chisq.npz" %group, best_chisq)
@@ -110,11 +99,6 @@ def infer_spectra(ds, m):
     return m.model_spectra
 
 
-def test_step_iteration(ds, m, starting_guess):
-    errs, chisq = m.infer_labels(ds, starting_guess)
-    return ds.test_label_vals, chisq, errs
-
-
 def load_dataset(ii):
     ("loading data")
     groups = np.load("ref_groups.npz")['arr_0']
@@ -85,11 +85,13 @@ model = model.CannonModel(2) # 2 = quadratic model
 model.fit(data) # model.train would work equivalently.
 np.savez("./model_coeffs", model.coeffs)
 np.savez("./model_scatter", model.scatters)
-np.savez("./model_chisqs", model.chisqs)
+np.savez("./model_star_chisqs", model.star_chisqs)
+np.savez("./model_pixel_chisqs", model.pixel_chisqs)
 np.savez("./model_pivots", model.pivots)
 model.coeffs = np.load("./model_coeffs.npz")['arr_0']
 model.scatters = np.load("./model_scatter.npz")['arr_0']
-model.chisqs = np.load("./model_chisqs.npz")['arr_0']
+model.star_chisqs = np.load("./model_star_chisqs.npz")['arr_0']
+model.pixel_chisqs = np.load("./model_pixel_chisqs.npz")['arr_0']
 model.pivots = np.load("./model_pivots.npz")['arr_0']
 
 # check the model
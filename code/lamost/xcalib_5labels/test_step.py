@@ -20,11 +20,6 @@ rc('text', usetex=True)
 import os
 
 
-def test_step_iteration(ds, m, starting_guess):
-    errs, chisq = m.infer_labels(ds, starting_guess)
-    return ds.test_label_vals, chisq, errs
-
-
 def test_step(date):
     direc = "../xcalib_4labels"
     wl = np.load("%s/wl.npz" %direc)['arr_0']
@@ -36,14 +31,16 @@ def test_step(date):
     lamost_label = np.load("%s/output/%s_tr_label.npz" %(direc,date))['arr_0']
     apogee_label = np.load("./tr_label.npz")['arr_0']
 
-    ds = dataset.Dataset(wl, test_ID, test_flux[0:2,:], test_ivar[0:2,:], lamost_label, 
-            test_ID, test_flux, test_ivar)
+    ds = dataset.inference_dataset(wl, test_ID, test_flux, test_ivar)
+    # LAMOST labels of the test objects, for the 1-to-1 plots
+    ds.tr_label = lamost_label
     ds.set_label_names(['T_{eff}', '\log g', '[M/H]', '[\\alpha/Fe]', 'A_k'])
 
     m = model.CannonModel(2)
     m.coeffs = np.load("./coeffs.npz")['arr_0']
     m.scatters = np.load("./scatters.npz")['arr_0']
-    m.chisqs = np.load("./chisqs.npz")['arr_0']
+    m.star_chisqs = np.load("./star_chisqs.npz")['arr_0']
+    m.pixel_chisqs = np.load("./pixel_chisqs.npz")['arr_0']
     m.pivots = np.load("./pivots.npz")['arr_0']
 
     nlabels = len(m.pivots)
@@ -53,26 +50,13 @@ def test_step(date):
     choose = np.random.randint(0,nobj,size=nguesses)
     starting_guesses = apogee_label[choose]-m.pivots
 
-    labels = np.zeros((nguesses, nobj, nlabels)) 
-    chisq = np.zeros((nguesses, nobj))
-    errs = np.zeros(labels.shape)
-    
-    for ii,guess in enumerate(starting_guesses):
-        a,b,c = test_step_iteration(ds,m,starting_guesses[ii])
-        labels[ii,:] = a
-        chisq[ii,:] = b
-        errs[ii,:] = c
+    best_errs, best_chisq, labels, errs, chisq, pruned = m.infer_labels(
+            ds, starting_guesses, return_candidates=True)
+    best_labels = ds.test_label_vals
 
     np.savez("output/%s_cannon_label_guesses.npz" %date, labels)
     np.savez("output/%s_cannon_chisq_guesses.npz" %date, labels)
-
-    choose = np.argmin(chisq, axis=0)
-    best_chisq = np.min(chisq, axis=0)
-    best_labels = np.zeros((nobj, nlabels))
-    best_errs = np.zeros(best_labels.shape)
-    for jj,val in enumerate(choose):
-        best_labels[jj,:] = labels[:,jj,:][val]
-        best_errs[jj,:] = errs[:,jj,:][val]
+    np.savez("output/%s_cannon_pruned_guesses.npz" %date, pruned)
 
     np.savez("output/%s_all_cannon_labels.npz" %date, best_labels)
     np.savez("output/%s_cannon_label_chisq.npz" %date, best_chisq)
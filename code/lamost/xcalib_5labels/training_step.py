@@ -69,7 +69,8 @@ def train():
     m.fit(ds)
     np.savez("./coeffs.npz", m.coeffs)
     np.savez("./scatters.npz", m.scatters)
-    np.savez("./chisqs.npz", m.chisqs)
+    np.savez("./star_chisqs.npz", m.star_chisqs)
+    np.savez("./pixel_chisqs.npz", m.pixel_chisqs)
     np.savez("./pivots.npz", m.pivots)
     m.diagnostics_leading_coeffs(ds)
     m.diagnostics_leading_coeffs_triangle(ds)